@@ -104,23 +104,26 @@ class Scorer (object):
 class Tester (object):
   def __init__ (self, log):
     self.log = log
-    self.checks = []
+    self._total = 0 # Number of checks so far
+    self._failed = 0 # ...and how many of them failed
 
   def expect_eq (self, expected, got, desc):
-    msg = "check {0}: {1}".format(len(self.checks), desc)
+    n = self._total
+    self._total += 1
 
     if expected == got:
-      self.checks.append(True)
-      self.log.info("{0}: OK".format(msg))
+      # Most checks pass, so leave formatting to the logger
+      self.log.info("check %s: %s: OK", n, desc)
     else:
-      self.checks.append(False)
+      self._failed += 1
+      msg = "check {0}: {1}".format(n, desc)
       self.log.error("{0}: FAIL. Expected \"{1}\", got \"{2}\"".format(msg, expected, got))
 
   def expect_true (self, got, desc):
     self.expect_eq(True, got, desc)
 
   def finish (self):
-    all_ok = all(self.checks)
+    all_ok = not self._failed
     if all_ok:
       self.log.info("All checks passed, test PASSED")
     else:
@@ -83,12 +83,11 @@ def launch (log_name="s3_t1", data="", drop_count=0,
     class drop_one_pass_one(object):
       def __init__ (self):
         self.dropnext = True
-        self.sent_pkts = {}
+        self.sent_pkts = set()
 
-      def __call__ (self, dev, packet):
-        tcp = packet.find("tcp")
+      def __call__ (self, dev, packet, tcp):
         # only packets with payload
-        if not tcp or not tcp.payload:
+        if not tcp.payload:
           return False
 
         k = tcp.seq
@@ -98,11 +97,11 @@ def launch (log_name="s3_t1", data="", drop_count=0,
           return True
         else:
           self.dropnext = True
-          self.sent_pkts[k] = True
+          self.sent_pkts.add(k)
           log.info("let packet through seq={0}, ack={1}".format(k, tcp.ack))
           return False
 
-    topo.get_wire(r1,c1).drop_conditions.append(drop_one_pass_one())
+    topo.get_wire(r1,c1).add_drop_condition(drop_one_pass_one(), "tcp")
 
     def on_end ():
       try:
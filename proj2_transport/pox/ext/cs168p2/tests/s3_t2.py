@@ -11,13 +11,13 @@ from ast import literal_eval
 
 
 class RXApp (SimpleReSocketApp):
-  # Missing rx_buffer = b''
+  # Missing rx_buffer = bytearray()
   @task_function
   def _on_connected (self):
     while True:
       d = yield self.sock.recv(1, at_least=True)
       if not d: break
-      self.rx_buffer += d
+      self.rx_buffer.extend(d)
 
 
 
@@ -25,6 +25,7 @@ def launch (log_name="", data="", drop_count=0,
             run_time=5, server_isn=None):
 
   data = "**Hello, CS168!**" * 240
+  expected = data.encode('ascii')
 
   def setup ():
     log = core.getLogger(log_name)
@@ -56,14 +57,10 @@ def launch (log_name="", data="", drop_count=0,
     child_kwargs = dict(data=data)
     sapp = s1.netcat(port=1000, listen=True, child_kwargs=child_kwargs)
     capp = c1._new_resocket_app(RXApp, ip=s1_ip, port=1000, delay=0.5)
-    capp.rx_buffer = b''
+    capp.rx_buffer = bytearray()
 
     pkts = []
-    def on_cap (e):
-      parsed = e.parsed
-      if not parsed: return
-      parsed = parsed.find("tcp")
-      if not parsed: return
+    def on_cap (e, parsed):
       # Giant hack, but just tack this stuff on
       parsed._devname = e.dev.name
       parsed._client = e.dev is r1c1_dev
@@ -72,10 +69,10 @@ def launch (log_name="", data="", drop_count=0,
       parsed._client_state = csock.state if csock else None
       pkts.append(parsed)
       #print e.dev,parsed.dump()
-    r1.stack.add_packet_capture("*", on_cap, ip_only=True)
+    r1.stack.add_packet_capture("*", on_cap, ip_only=True, protocol="tcp")
 
     def do_score ():
-      tester.expect_eq(data.encode('ascii'), capp.rx_buffer, "payload correctly received")
+      tester.expect_eq(expected, bytes(capp.rx_buffer), "payload correctly received")
 
       # # pkts = 3 for hs + 3 payload + 1-3 payload ack + maybe 4 for close + 1 threshold
       #tester.expect_true(12 <= len(pkts) <= 14, "4 <= num of packets <= 10")
@@ -84,12 +81,11 @@ def launch (log_name="", data="", drop_count=0,
 
       def __init__ (self):
         self.dropnext = True
-        self.sent_pkts = {}
+        self.sent_pkts = set()
 
-      def __call__ (self, dev, packet):
-        tcp = packet.find("tcp")
+      def __call__ (self, dev, packet, tcp):
         # only packets with payload
-        if not tcp or not tcp.payload:
+        if not tcp.payload:
           return False
 
         k = tcp.seq
@@ -99,11 +95,11 @@ def launch (log_name="", data="", drop_count=0,
           return True
         else:
           self.dropnext = True
-          self.sent_pkts[k] = True
+          self.sent_pkts.add(k)
           log.info("let packet through seq={0}, ack={1}".format(k, tcp.ack))
           return False
 
-    topo.get_wire(r1,c1).drop_conditions.append(drop_one_pass_one())
+    topo.get_wire(r1,c1).add_drop_condition(drop_one_pass_one(), "tcp")
 
     def on_end ():
       try:
@@ -58,15 +58,11 @@ def launch (log_name="", run_time=3, server_isn=None):
     pkts = []
     client_socket = None
 
-    def on_cap (e):
+    def on_cap (e, parsed):
       if not pkts:
         global client_socket
         client_socket = get_client_socket()
 
-      parsed = e.parsed
-      if not parsed: return
-      parsed = parsed.find("tcp")
-      if not parsed: return
       # Giant hack, but just tack this stuff on
       parsed._devname = e.dev.name
       parsed._client = e.dev is r1c1_dev
@@ -76,7 +72,7 @@ def launch (log_name="", run_time=3, server_isn=None):
       pkts.append(parsed)
       #print e.dev,parsed.dump()
 
-    r1.stack.add_packet_capture("*", on_cap, ip_only=True)
+    r1.stack.add_packet_capture("*", on_cap, ip_only=True, protocol="tcp")
 
     def from_server(p):
       return p._server and not p._client
@@ -59,14 +59,18 @@ def init_standard_topo (topo, num_clients=1, num_servers=1):
   topo.default_queue_factory = topo.make_factory(InfinityQueue)
   topo.default_wire_factory = topo.make_factory(InfinityWire)
 
+  # Nearly all the time in these loops is building each Node's stack and
+  # socket manager, so there's no real gain from a bulk add_node().
+  base = IPAddr("10.0.0.0").toUnsigned()
   for c in range(1, 1+num_clients):
-    ip = IPAddr("10.0.0.%s" % (c,))
+    ip = IPAddr(base + c)
     n = sim_nodes.Node("c" + str(c)) #str(ip))
     _,dev,_ = topo.add_node(n, r1)
     dev.ip_addr = ip
 
+  base = IPAddr("10.255.255.0").toUnsigned()
   for c in range(1, 1+num_servers):
-    ip = IPAddr("10.255.255.%s" % (c,))
+    ip = IPAddr(base + c)
     n = sim_nodes.Node("s" + str(c)) #str(ip))
     _,dev,_ = topo.add_node(n, r2)
     dev.ip_addr = ip
@@ -91,17 +95,38 @@ def simple_test (virtual_time=False, clients=1, servers=1):
 
 
 
-def _new_app (node, f_name, port=0, ip=None, listen=False, **kw):
-  def do_it (n):
-    f = getattr(n, f_name)
-    o = f(ip=ip, port=int(port), listen=listen, **kw)
+_pending_up = [] # (function, node name, args) to call once POX is up
+
+def _handle_UpEvent (e):
+  pending = _pending_up[:]
+  del _pending_up[:]
+  get_node = core.sim_topo.get_node
+  for f,node,args in pending:
+    f(get_node(node), *args)
+
+
+def _call_when_up (f, node, *args):
+  """
+  Calls f(<the node named node>, *args) once POX is up
+
+  All such calls share a single UpEvent listener.  If POX is already up,
+  f is called immediately.
+  """
   if core.starting_up:
-    def _handle_UpEvent (e):
-      n = core.sim_topo.get_node(node)
-      do_it(n)
-    core.add_listener(_handle_UpEvent)
+    if not _pending_up:
+      core.add_listener(_handle_UpEvent, once=True)
+    _pending_up.append((f, node, args))
   else:
-    do_it(core.sim_topo.get_node(node))
+    f(core.sim_topo.get_node(node), *args)
+
+
+def _start_app (n, f_name, port, ip, listen, kw):
+  f = getattr(n, f_name)
+  f(ip=ip, port=int(port), listen=listen, **kw)
+
+
+def _new_app (node, f_name, port=0, ip=None, listen=False, **kw):
+  _call_when_up(_start_app, node, f_name, port, ip, listen, kw)
 
 
 def data_logger (node, port=0, ip=None, listen=False, delay=None,
@@ -123,13 +148,7 @@ def echo (node, port=0, ip=None, listen=False, __INSTANCE__=None):
 
 
 def small_services (node, __INSTANCE__=None):
-  def _handle_UpEvent (e):
-    n = core.sim_topo.get_node(node)
-    n.start_small_services()
-  if core.starting_up:
-    core.add_listener(_handle_UpEvent)
-  else:
-    _handle_UpEvent()
+  _call_when_up(sim_nodes.Node.start_small_services, node)
 
 
 def fast_sender (node, bytes, delay=0, port=0, ip=None, listen=False,
@@ -198,14 +217,25 @@ def add_route (node, prefix, gw=None, dev=None, metric=1, __INSTANCE__=None):
 
 
 
+def _get_wires (node1, node2):
+  """
+  Returns the (node1->node2, node2->node1) wires
+
+  The connecting devices are only looked up once for both directions.
+  """
+  t = core.sim_topo
+  d1,d2 = t.get_devs(t.get_node(node1), t.get_node(node2))
+  return t.wires[d1,d2], t.wires[d2,d1]
+
+
+
 def random_loss (loss, node1="r1", node2="r2", unidirectional=False,
                  __INSTANCE__=None):
   loss = float(loss)
-  l = core.sim_topo.get_wire(node1, node2)
-  l.sniffers.append(RandomDropper(loss, seed=node1+"."+node2))
+  l1,l2 = _get_wires(node1, node2)
+  l1.add_drop_condition(RandomDropper(loss, seed=node1+"."+node2))
   if not unidirectional:
-    l = core.sim_topo.get_wire(node2, node1)
-    l.sniffers.append(RandomDropper(loss, seed=node2+"."+node1))
+    l2.add_drop_condition(RandomDropper(loss, seed=node2+"."+node1))
 
 
 
@@ -216,11 +246,10 @@ def regular_loss (accept=None, drop=None, node1="r1", node2="r2",
   drop = int(drop)
   phase = accept if phase is True else int(phase)
   phase2 = accept if phase2 is True else int(phase2)
-  l = core.sim_topo.get_wire(node1, node2)
-  l.sniffers.append(RegularDropper(accept, drop, phase=phase))
+  l1,l2 = _get_wires(node1, node2)
+  l1.add_drop_condition(RegularDropper(accept, drop, phase=phase))
   if not unidirectional:
-    l = core.sim_topo.get_wire(node2, node1)
-    l.sniffers.append(RegularDropper(accept, drop, phase=phase2))
+    l2.add_drop_condition(RegularDropper(accept, drop, phase=phase2))
 
 
 
@@ -242,20 +271,19 @@ def set_ip (node, ip, dev=None, devpat=None, first=False, __INSTANCE__=None):
   log = core.getLogger("set_ip")
   n = core.sim_topo.get_node(node)
   ip = IPAddr(ip)
+  netdevs = n.stack.netdevs
   if devpat:
     assert not dev, "Only one of dev or devpat"
     dev = devpat
     import fnmatch
-    matches = lambda a : fnmatch.fnmatch(a.name, devpat)
+    matching = [netdevs[name] for name in fnmatch.filter(netdevs, devpat)]
   elif dev is None:
     # No dev or devpat specified; just any dev with no IP
-    matches = lambda a : a.ip_addr is None
+    matching = [d for d in netdevs.values() if d.ip_addr is None]
   else:
-    assert not devpat, "Only one of dev or devpat"
-    matches = lambda a : a.name == dev
-  matching = []
-  for name,d in n.stack.netdevs.iteritems():
-    if matches(d): matching.append(d)
+    # Exact name, which is what netdevs is keyed on
+    d = netdevs.get(dev)
+    matching = [d] if d is not None else []
   if not matching:
     raise RuntimeError("No matching device (%s)" % (dev,))
   matching.sort(key=lambda d:d.name)
@@ -293,13 +321,15 @@ def log_at (time, message=None, repeating=False, __INSTANCE__=None):
   Logs a message at a given sim time
   """
   time = float(time)
+  # Look this up once; getLogger() without a name inspects the call stack
+  log = core.getLogger()
   def msg ():
     t = units.seconds_to_str(core.sim_topo.now, True)
     if message is None:
       m = "It is now %s" % (t,)
     else:
       m = t + ": " + message
-    core.getLogger().info(m)
+    log.info(m)
     if repeating:
       core.sim_topo.set_timer_in(time, msg)
 
@@ -324,14 +354,19 @@ def default_queue (type):
 
 
 import logging
+from . units import seconds_to_str as _seconds_to_str
 class SimTimeFilter (logging.Filter):
   time_manager = None
   def filter (self, record):
-    if not self.time_manager:
-      if not core.hasComponent("sim_topo"): return True
-      self.time_manager = core.sim_topo
-
-    record.msg = "[" + units.seconds_to_str(self.time_manager.now) + "] " + record.msg
+    if not core.hasComponent("sim_topo"): return True
+    self.time_manager = core.sim_topo
+    # From now on, skip straight to adding the time
+    self.filter = self._add_sim_time
+    return self.filter(record)
+
+  def _add_sim_time (self, record):
+    record.msg = ("[" + _seconds_to_str(self.time_manager.now) + "] "
+                  + record.msg)
     return True
 
 
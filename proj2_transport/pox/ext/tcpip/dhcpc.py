@@ -4,10 +4,15 @@ DHCP client
 
 from pox.proto.dhcp_client import DHCPClientBase
 import pox.lib.packet as pkt
-from pox.lib.addresses import IPAddr, EthAddr, netmask_to_cidr
+from pox.lib.addresses import IPAddr, EthAddr
+from pox.lib.addresses import netmask_to_cidr, cidr_to_netmask
 from pox.core import core
 
 
+# Netmask -> prefix length, for all the CIDR-compatible netmasks
+_netmask_bits = dict((cidr_to_netmask(b), b) for b in range(33))
+
+
 
 class DHCPClient (DHCPClientBase):
   add_default_route = True
@@ -22,7 +27,7 @@ class DHCPClient (DHCPClientBase):
     super(DHCPClient,self).__init__(port_eth=eth, total_timeout=100,
                                     auto_accept=True, name=name)
     self.log = core.getLogger("dhcpc").getChild(name)
-    netdev.stack.add_sniffer(lambda p: self._sniff(p))
+    netdev.stack.add_sniffer(self._sniff)
     self._really_finished = False
 
   def _check_done (self):
@@ -35,7 +40,9 @@ class DHCPClient (DHCPClientBase):
     size = 32
     gw = None
     if self.bound.subnet_mask:
-      size = netmask_to_cidr(self.bound.subnet_mask)
+      size = _netmask_bits.get(self.bound.subnet_mask)
+      if size is None: # Not CIDR-compatible; let netmask_to_cidr() complain
+        size = netmask_to_cidr(self.bound.subnet_mask)
     if self.bound.routers:
       gw = self.bound.routers[0]
       r = self.netdev.stack.add_route(prefix=gw, dev=self.netdev)
@@ -57,12 +64,18 @@ class DHCPClient (DHCPClientBase):
     return True
 
   def _sniff (self, packet):
-    if self._check_done(): return True # Remove sniffer
+    if self._really_finished or self._check_done():
+      return True # Remove sniffer
     if packet.rx_dev is not self.netdev: return
-    if packet.ipv4 is None: return
-    dhcp = packet.ipv4.find('dhcp')
-    if dhcp is None: return
-    self._rx(packet.ipv4)
+    ipp = packet.ipv4
+    if ipp is None or ipp.protocol != ipp.UDP_PROTOCOL: return
+    # Only look for DHCP in replies to the client port; _rx() does the rest
+    udpp = ipp.payload
+    if type(udpp) is not pkt.udp: return
+    if udpp.dstport != pkt.dhcp.CLIENT_PORT: return
+    self._rx(ipp)
+    # We don't keep our sniffer handle, so returning True is what gets us
+    # removed -- right after the packet that finished the lease.
     if self._check_done(): return True # Remove sniffer
 
   def _send_data (self, raw):
@@ -22,6 +22,10 @@ object has a deterministic string representation).
 #TODO: ProgrammableDropper (takes a list of things to drop)
 
 import random
+import math
+from pox.core import core
+
+log = core.getLogger()
 
 
 
@@ -30,20 +34,32 @@ class RandomDropper (object):
   A simple drop-deciding functoid
 
   Usable as both a wire-dropper and queue dropper
+
+  drop_fraction is either a number or a function which returns one (so
+  that the loss rate can change over time).
   """
   seed = 0
+  _thresh = None # The drop fraction if it's constant
   def __init__ (self, drop_fraction, seed=seed):
-    self._random = None
+    self._rngs = {} # id(obj) -> random() of that obj's own Random
+    if not callable(drop_fraction):
+      # Keep it so we can skip calling _drop_fraction for every packet
+      self._thresh = float(drop_fraction)
+      drop_fraction = self._thresh.__float__
     self._drop_fraction = drop_fraction
     self.seed = seed
 
+  def _new_rng (self, obj):
+    # Seed in the constructor; Random() alone would first seed from urandom
+    r = random.Random(hash(str(obj)) ^ hash(self.seed))
+    rand = self._rngs[id(obj)] = r.random
+    return rand
+
   def __call__ (self, obj, packet):
-    if self._random is None:
-      self._random = random.Random()
-      self._random.seed(hash(str(obj)) ^ self.seed)
-    if self._random.random() < self._drop_fraction():
-      return True
-    return False
+    rand = self._rngs.get(id(obj)) or self._new_rng(obj)
+    thresh = self._thresh
+    if thresh is None: thresh = self._drop_fraction()
+    return rand() < thresh
 
 
 
@@ -55,12 +71,19 @@ class RegularDropper (object):
     self.accept = accept
     if deny is None: deny = accept
     self.deny = deny
-    self.phase = phase % (accept+deny)
+    self._period = accept + deny
+    self.phase = phase % self._period
+    # The drop decision for each phase (truthy means drop)
+    self._pattern = bytes(bytearray([0] * accept + [1] * deny))
 
   def __call__ (self, obj, packet):
+    # This is already about as cheap as a Python call gets; the call itself
+    # is most of the cost.  phase is deliberately a plain attribute; keeping
+    # it in a one-element array('i') was measurably slower.
     p = self.phase
-    self.phase = (self.phase + 1) % (self.accept+self.deny)
-    return p >= self.accept
+    n = p + 1
+    self.phase = n if n < self._period else 0
+    return self._pattern[p]
 
 
 
@@ -110,38 +133,54 @@ class REDDropper (object):
 
     self._random = None
 
+    # Loop invariants for __call__
+    self._one_minus_wq = 1.0 - self.wq
+    self._log_one_minus_wq = math.log1p(-self.wq)
+    self._th_range_inv = 1.0 / (self.max_th - self.min_th)
+    self._apkt_bits = self.average_packet_size * 8.0
+    self._trans_times = {} # id(obj) -> average packet transmission time
+
     # This is a hack
     if getattr(type(self), "WARNED", False) is False:
+      type(self).WARNED = True
       log.warn("Using REDDropper which is totally untested")
 
+  def _trans_time (self, obj):
+    wire = obj.topo.get_wire(obj.src, obj.dst)
+    t = self._trans_times[id(obj)] = self._apkt_bits / wire.rate
+    return t
+
   def __call__ (self, obj, packet):
     if self._random is None:
-      self._random = random.Random()
-      self._random.seed(hash(str(obj)) ^ self.seed)
+      self._random = random.Random(hash(str(obj)) ^ self.seed)
 
     qlen = len(obj)
     idle_at = obj.idle_at
     if idle_at is None: # Not idle
       qlen += 1 # Include the one being transmitted
-      self.avg = (1-self.wq) * self.avg + self.wq * qlen
+      avg = self._one_minus_wq * self.avg + self.wq * qlen
     else:
       idle_time = obj.topo.now - idle_at
-      trans_time = (self.average_packet_size * 8.0) / obj.rate
+      trans_time = self._trans_times.get(id(obj)) or self._trans_time(obj)
       m = idle_time / trans_time # num packets Might have been xmitted
-      self.avg = ((1-self.wq) ** m) * avg
+      # (1-wq)**m, but cheaper since log(1-wq) is precomputed
+      avg = math.exp(m * self._log_one_minus_wq) * self.avg
       # The above is what the paper says as best as I can figure; I don't
       # immediately have any sense of why it'd be right, and I haven't
       # worked through it.
+    self.avg = avg
 
-    if self.min_th <= self.avg and self.avg < self.max_th:
-      self.count += 1
-      pb = self.maxp * (self.avg - self.min_th) / (self.max_th - self.min_th)
-      pa = pb / (1.0 - self.count * pb)
+    min_th = self.min_th
+    if avg < min_th:
+      self.count = -1
+    elif avg < self.max_th:
+      count = self.count + 1
+      pb = self.max_p * (avg - min_th) * self._th_range_inv
+      pa = pb / (1.0 - count * pb)
       if self._random.random() < pa:
         self.count = 0
         return True # Drop!
-    elif self.max_th <= self.avg:
+      self.count = count
+    else:
       self.count = 0
       return True # Drop!
-    else:
-      self.count = -1
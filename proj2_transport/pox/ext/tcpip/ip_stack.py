@@ -35,7 +35,13 @@ Specifically, some stuff that's in here:
 
 
 import time
+import copy
 import fnmatch
+import re
+import heapq
+import itertools
+import operator
+import functools
 
 from pox.lib.addresses import IPAddr, IP_ANY
 
@@ -51,30 +57,91 @@ log = core.getLogger()
 
 
 
+def _is_bcast_or_mcast (ip):
+  """
+  Same as (ip.is_broadcast or ip.is_multicast), but cheaper
+
+  Both properties go through IPAddr's Python-level conversions.
+  is_multicast tests the top three bits (so it covers 224/3, not just
+  224/4), which also takes in 255.255.255.255, so one mask does it.
+  """
+  return (ip.toUnsigned() & 0xe0000000) == 0xe0000000
+
+
+
+def _flow_key (dev, ip1, port1, ip2, port2):
+  """
+  Packs a (dev, IP, port, IP, port) flow into a single int
+
+  This makes for a cheaper dict key than the tuple, whose hash and compare
+  go through IPAddr's Python-level methods.  dev only contributes its id(),
+  so whoever owns the key must keep dev alive (MasqEntry does).
+  """
+  return ((id(dev) << 96) | (ip1.toUnsignedN() << 64) | (port1 << 48)
+          | (ip2.toUnsignedN() << 16) | port2)
+
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_glob (pattern):
+  """
+  Returns a match function for a (case-sensitive) glob pattern
+
+  Same matching as fnmatch.fnmatchcase(), but gives the caller the
+  compiled matcher to use across many names.
+  """
+  return re.compile(fnmatch.translate(pattern)).match
+
+
+
 class MasqEntry (object):
+  __slots__ = ('near_ip', 'near_port', 'out_dev', 'out_port', 'in_dev',
+               'out_tuple', 'in_tuple', 'stack', 'ts', '_expire_time')
+
   expire_time = 60*5
   expire_time_close = 60
 
   @staticmethod
   def make_tuple (p):
-    return (p.rx_dev,p.ipv4.srcip,p.tcp.srcport,p.ipv4.dstip,p.tcp.dstport)
+    """
+    Returns the flow key for the packet (see _flow_key())
+    """
+    return _flow_key(p.rx_dev, p.ipv4.srcip, p.tcp.srcport,
+                     p.ipv4.dstip, p.tcp.dstport)
 
-  def __init__ (self, stack, p, out_dev, out_port):
+  def __init__ (self, stack, p, out_dev, out_port, out_tuple=None):
+    """
+    out_tuple is make_tuple(p), if the caller already has it
+    """
     self.near_ip = p.ipv4.srcip
     self.near_port = p.tcp.srcport
     self.out_dev = out_dev
     self.out_port = out_port
     self.in_dev = p.rx_dev
-    self.out_tuple = self.make_tuple(p)
-    t = (out_dev,p.ipv4.dstip,p.tcp.dstport,out_dev.ip_addr,out_port)
-    self.in_tuple = t
+    if out_tuple is None: out_tuple = self.make_tuple(p)
+    self.out_tuple = out_tuple
+    self.in_tuple = _flow_key(out_dev, p.ipv4.dstip, p.tcp.dstport,
+                              out_dev.ip_addr, out_port)
     self.stack = stack
+    self._expire_time = self.expire_time # Shortened on FIN/RST
     self.update(p)
 
   def update (self, p):
+    """
+    Refresh the entry's timestamp
+
+    Returns True if this shortened expire_time.
+    """
     self.ts = self.stack.now
     if p is not None and (p.tcp.FIN or p.tcp.RST):
-      self.expire_time = min(self.expire_time,self.expire_time_close)
+      if self._expire_time > self.expire_time_close:
+        self._expire_time = self.expire_time_close
+        return True
+    return False
+
+  @property
+  def expires_at (self):
+    return self.ts + self._expire_time
 
 
 
@@ -95,6 +162,12 @@ class MasqTable (object):
     self._expire_counter = 0
     self.stack = stack
 
+    # Heap of (expires_at, seq, out_tuple).  An entry's time in here may be
+    # stale since traffic keeps pushing it back, so _do_expirations() checks
+    # the real time and re-pushes entries which are still alive.
+    self._expiry_heap = []
+    self._expiry_seq = itertools.count() # Tie-breaker, keeps FIFO order
+
     # Should we have our own defragmenter(s)?
     self.in_defragger = stack.defragger
     self.out_defragger = stack.defragger
@@ -123,12 +196,17 @@ class MasqTable (object):
     me = self._out_table.get(t)
     if me is None:
       self._maybe_do_expirations()
-      me = MasqEntry(self.stack, p, out_dev, self._get_next_out_port())
+      me = MasqEntry(self.stack, p, out_dev, self._get_next_out_port(), t)
       self._out_table[t] = me
       self._in_table[me.in_tuple] = me
-    me.update(p)
+      self._schedule_expiry(me)
+    if me.update(p): self._schedule_expiry(me)
     return me
 
+  def _schedule_expiry (self, me):
+    heapq.heappush(self._expiry_heap,
+                   (me.expires_at, next(self._expiry_seq), me.out_tuple))
+
   def rewrite_out (self, p, out_dev):
     if not out_dev.ip_addr: return False
     p = self.out_defragger.rx_fragment(p)
@@ -144,10 +222,22 @@ class MasqTable (object):
     t = MasqEntry.make_tuple(p) # make_in_tuple()?
     me = self._in_table.get(t)
     if me is not None:
-      me.update(p)
+      if me.update(p): self._schedule_expiry(me)
     return me
 
+  def has_in_tuple (self, p):
+    """
+    Quick check of whether p may belong to a masqueraded connection
+
+    Only unfragmented packets and first fragments carry the ports, so
+    this is only conclusive for those.  For anything else, it says yes
+    and leaves it to the caller to defragment and check properly.
+    """
+    if p.ipv4.frag or p.tcp is None: return True
+    return MasqEntry.make_tuple(p) in self._in_table
+
   def rewrite_in (self, p):
+    if not self.has_in_tuple(p): return False
     p = self.in_defragger.rx_fragment(p)
     if not p: return False
     me = self.get_entry_in(p)
@@ -159,24 +249,37 @@ class MasqTable (object):
     return False
 
   def _do_expirations (self):
-    dead = []
     ts = self.stack.now
-    for t,me in self._out_table.items():
-      if ts - me.ts > me.expire_time:
-        dead.append((t,me))
+    heap = self._expiry_heap
+    dead = 0
+    while heap and heap[0][0] < ts:
+      _,_,t = heapq.heappop(heap)
+      me = self._out_table.get(t)
+      if me is None: continue # Already gone
+      expires_at = me.expires_at
+      if expires_at < ts:
+        del self._in_table[me.in_tuple]
+        del self._out_table[t]
+        dead += 1
+      else:
+        # Still in use; check again when it might really be expired
+        heapq.heappush(heap, (expires_at, next(self._expiry_seq), t))
     if dead:
-      self.stack.log.debug("Expiring %s masquerading entries", len(dead))
-    for t,me in dead:
-      del self._in_table[me.in_tuple]
-      del self._out_table[t]
+      self.stack.log.debug("Expiring %s masquerading entries", dead)
 
 
 
 class Route (object):
+  __slots__ = ('prefix', 'size', 'metric', 'gw', 'dev_name',
+               'prefix_int', 'mask_int')
+
   route_id = 0
   exportable = True
   def __init__ (self, prefix, size, metric, gw = None, dev_name = None):
-    if prefix.get_network(size)[0] != prefix:
+    # Unsigned ints in host order, like Routing uses
+    self.prefix_int = prefix.toUnsigned()
+    self.mask_int = (0xffFFffFF << (32-size)) & 0xffFFffFF
+    if self.prefix_int & self.mask_int != self.prefix_int:
       raise RuntimeError("Route has the wrong size")
     self.prefix = prefix
     self.size = size
@@ -218,23 +321,51 @@ class Route (object):
 
 
 
+_metric_key = operator.attrgetter('metric') # Sort key for Routes
+
+
+
 class Routing (object):
+  max_cache_size = 4096 # Flush the lookup cache when it grows past this
+
+  # _masks[x] is the netmask for prefix length x as an unsigned int
+  _masks = tuple((0xffFFffFF << (32-l)) & 0xffFFffFF for l in range(33))
+
   def __init__ (self):
     self.tables = [{} for _ in range(33)]
     # tables[x] -> prefixes of length x
-    # Individual tables are prefix->[Route] with the routes sorted by metric
+    # Individual tables are prefix->[Route] with the routes sorted by metric.
+    # The prefixes are unsigned ints (host order); use get() to look one up
+    # by IPAddr.
     # Since table 0 is a prefix size of 0, it will always match -- there
     # should only be zero or one keys in table 0.  If there is one, it
     # stores the default routes.
 
+    self._lengths = () # Sizes of the nonempty tables, longest first
+
+    # addr -> result of lookup(); flushed whenever a route is added
+    self._cache = {}
+
   def lookup (self, addr):
     """
     Returns matching Routes
     """
-    for l in range(32,-1,-1):
-      table = self.tables[l]
-      if not table: continue
-      e = table.get(addr.get_network(l)[0])
+    cache = self._cache
+    r = cache.get(addr)
+    if r is None:
+      if len(cache) >= self.max_cache_size: cache.clear()
+      r = cache[addr] = self._lookup(addr)
+    return r
+
+  def _lookup (self, addr):
+    """
+    Does the actual longest prefix match for lookup()
+    """
+    a = addr.toUnsigned()
+    tables = self.tables
+    masks = self._masks
+    for l in self._lengths:
+      e = tables[l].get(a & masks[l])
       if e: return e
     return []
 
@@ -246,15 +377,26 @@ class Routing (object):
     if not r: return None
     return r[0]
 
+  def get (self, prefix, size):
+    """
+    Returns the Routes for exactly prefix/size (or None)
+    """
+    return self.tables[size].get(IPAddr(prefix).toUnsigned())
+
   def __contains__ (self, route):
-    return bool(self.tables[route.size].get(route.prefix))
+    return bool(self.get(route.prefix, route.size))
 
   def add (self, route):
-    if not route in self:
-      self.tables[route.size][route.prefix] = [route]
+    self._cache.clear()
+    table = self.tables[route.size]
+    prefix = route.prefix_int
+    bucket = table.get(prefix)
+    if not bucket:
+      table[prefix] = [route]
+      self._lengths = tuple(l for l in range(32,-1,-1) if self.tables[l])
     else:
-      self.tables[route.size][route.prefix].append(route)
-      self.tables[route.size][route.prefix].sort(key = lambda r: r.metric)
+      bucket.append(route)
+      bucket.sort(key = _metric_key)
 
   def get_all_routes (self):
     r = []
@@ -273,6 +415,12 @@ class Routing (object):
 
 
 class Packet (object):
+  # The fields are slots, but __dict__ is kept so that other code can still
+  # hang its own attributes on a Packet (only those Packets get a dict).
+  _fields = ('eth', 'ipv4', 'tcp', 'udp', 'icmp',
+             'rx_dev', 'create_ts', 'tx_ts', 'retx_ts', 'timeout_count')
+  __slots__ = _fields + ('__dict__',)
+
   ts_function = staticmethod(lambda: core.IPStack.now)
 
   def __init__ (self, ts=None):
@@ -286,8 +434,9 @@ class Packet (object):
 
   def clone (self):
     p = type(self)(ts=False)
-    for k,v in vars(self).items():
-      setattr(p, k, v)
+    for k in self._fields:
+      setattr(p, k, getattr(self, k))
+    p.__dict__.update(self.__dict__)
     return p
 
   def clear_data_pointers (self):
@@ -362,6 +511,8 @@ class Packet (object):
 
 
 class Fragment (object):
+  __slots__ = ('frags', 'assembled', 'failed', 'ts', 'defragmenter')
+
   def __init__ (self, ts, defragmenter=None):
     self.frags = {} # off -> Packet
     self.assembled = None
@@ -383,7 +534,6 @@ class Fragment (object):
     if self.assembled: return
     if self.failed: return
     try:
-      data = b''
       first = self.frags[0].ipv4
       length = 0
       # The packet library doesn't store raw data, unfortunately (a long-lived
@@ -396,6 +546,8 @@ class Fragment (object):
         self.log.warn("Can't reassemble fragments")
         self.failed = True
         return
+      # Appending to a bytearray is amortized linear (unlike bytes)
+      data = bytearray(data)
       cur = first
       while True:
         if cur.iplen <= 8:
@@ -407,14 +559,19 @@ class Fragment (object):
         if len(data) > 0xffff:
           self.failed = True
           return
-        if nxt.ipv4.flags & nxt.ipv4.MF_FLAG: continue
+        cur = nxt.ipv4
+        if cur.flags & cur.MF_FLAG: continue
         break
 
-      copy = pkt.ipv4(raw=first.pack())
-      copy.payload = data
-      copy = pkt.ipv4(raw=copy.pack())
+      # Reuse the first fragment's header, but it's no longer a fragment.
+      # A single pack and parse also gets us the parsed transport layer.
+      ipp = copy.copy(first)
+      ipp.flags &= ~ipp.MF_FLAG
+      ipp.frag = 0
+      ipp.payload = bytes(data)
+      ipp = pkt.ipv4(raw=ipp.pack())
       p = self.frags[0].clone().clear_data_pointers()
-      p.ipv4 = copy
+      p.ipv4 = ipp
       p.break_payload()
       self.assembled = p
       self.log.debug("Assembled %s fragments", len(self.frags))
@@ -435,6 +592,11 @@ class Defragmenter (object):
     self.stack = stack
     self.frags = {} # ID -> Fragment
 
+    # Heap of (expires_at, seq, ID), one per Fragment created.  IDs get
+    # reused, so do_expirations() checks the Fragment it actually finds.
+    self._expiry_heap = []
+    self._expiry_seq = itertools.count() # Tie-breaker; IDs may not compare
+
   def rx_fragment (self, p):
     if (p.ipv4.flags & p.ipv4.MF_FLAG) or p.ipv4.frag:
       pass
@@ -442,16 +604,21 @@ class Defragmenter (object):
       return p
 
     fid = self.get_id(p)
-    if fid not in self.frags:
-      if len(self.frags) >= self.MAX_FRAGS:
+    frags = self.frags
+    f = frags.get(fid)
+    if f is None:
+      now = self.stack.now
+      heap = self._expiry_heap
+      if heap and heap[0][0] < now:
         self.do_expirations()
-        if len(self.frags) >= self.MAX_FRAGS:
-          self.stack.log.debug("Too many fragments")
-          return None
-      self.frags[fid] = Fragment(ts=self.stack.now, defragmenter=self)
-    self.frags[fid].add(p)
-    r = self.frags[fid].assembled
-    if r is not None: del self.frags[fid]
+      if len(frags) >= self.MAX_FRAGS:
+        self.stack.log.debug("Too many fragments")
+        return None
+      f = frags[fid] = Fragment(ts=now, defragmenter=self)
+      heapq.heappush(heap, (now + self.MAX_AGE, next(self._expiry_seq), fid))
+    f.add(p)
+    r = f.assembled
+    if r is not None: del frags[fid]
     return r
 
   @staticmethod
@@ -461,12 +628,18 @@ class Defragmenter (object):
   def do_expirations (self):
     #TODO: We should send an ICMP time exceeded...
     now = self.stack.now
-    def expired (f):
-      return now - f.ts > self.MAX_AGE
-    bad = [k for k,v in self.frags if expired(v)]
-    for k in bad:
-      del self.frags[k]
-    self.stack.log.debug("Removed %s expired fragments", len(bad))
+    heap = self._expiry_heap
+    frags = self.frags
+    dead = 0
+    while heap and heap[0][0] < now:
+      _,_,fid = heapq.heappop(heap)
+      f = frags.get(fid)
+      if f is None: continue # Already assembled (or expired)
+      if now - f.ts <= self.MAX_AGE: continue # A newer one with the same ID
+      del frags[fid]
+      dead += 1
+    if dead:
+      self.stack.log.debug("Removed %s expired fragments", dead)
 
 
 
@@ -477,6 +650,9 @@ class IPStack (object):
   enable_ip_forward = True
   name = None
 
+  arp_dedup_time = 0.1 # Repeats of an ARP sender within this are ignored
+  _arp_seen_max = 1024 # Flush the ARP dedup table when it grows past this
+
   def __repr__ (self):
     if self.name:
       return "<%s %s>" % (type(self).__name__, self.name)
@@ -493,10 +669,12 @@ class IPStack (object):
       self.time = time
 
     self.netdevs = {} # name -> NetDev -- do not add manually
+    self._local_ips = {} # IPAddr -> NetDev with that address
 
     self.routing = routing
 
     self.arp_table = ARPTable()
+    self._arp_seen = {} # (protosrc,hwsrc) -> time last passed to arp_table
 
     self.defragger = Defragmenter(self)
 
@@ -507,6 +685,7 @@ class IPStack (object):
     do_masq_expire(skip=True)
 
     self._sniffers = {}
+    self._sniffers_snapshot = () # tuple(_sniffers.items()) for rx()
     self._next_sniffer = 1
 
   def get_netdev (self, name):
@@ -517,10 +696,10 @@ class IPStack (object):
     If the pattern would match more than one, raises an exception.
     Returns None if none found.
     """
-    # Possibly more efficient to use fnmatch.filter(self.netdevs.keys())...
+    match = _compile_glob(name)
     r = None
     for k,v in self.netdevs.items():
-      if fnmatch.fnmatchcase(k, name):
+      if match(k):
         if r is not None: raise RuntimeError("More than one match")
         r = v
     return r
@@ -529,27 +708,42 @@ class IPStack (object):
     """
     Gets all netdevs matching a glob pattern
     """
-    # Possibly more efficient to use fnmatch.filter(self.netdevs.keys())...
-    r = []
-    for k,v in self.netdevs.items():
-      if fnmatch.fnmatchcase(k, name):
-        r.append(v)
-    return r
+    match = _compile_glob(name)
+    return [v for k,v in self.netdevs.items() if match(k)]
 
   @property
   def now (self):
     return self.time.now
 
+  @property
+  def now_ms (self):
+    """
+    The current time in whole milliseconds
+    """
+    return int(self.time.now * 1000)
+
   def has_ip (self, ip):
-    ip = IPAddr(ip)
-    for d in self.netdevs.values():
-      if d.has_ip(ip): return True
-    return False
+    return IPAddr(ip) in self._local_ips
 
   def add_netdev (self, netdev):
     if netdev.stack: raise RuntimeError("NetDev already has IP stack")
     self.netdevs[netdev.name] = netdev
     netdev.stack = self
+    self._ip_addr_changed(netdev, None, netdev.ip_addr)
+
+  def _ip_addr_changed (self, netdev, old, new):
+    """
+    Keeps _local_ips up to date; called by NetDev when its IP changes
+    """
+    if old is not None and self._local_ips.get(old) is netdev:
+      del self._local_ips[old]
+      # Another device may have the same address
+      for d in self.netdevs.values():
+        if d.ip_addr == old:
+          self._local_ips[old] = d
+          break
+    if new is not None:
+      self._local_ips.setdefault(new, netdev)
 
   def lookup_dst (self, addr):
     """
@@ -575,9 +769,26 @@ class IPStack (object):
 
     return self.netdevs.get(r.dev_name),gw
 
+  def _arp_table_rx (self, arpp):
+    """
+    Passes an ARP on to the ARP table unless it's a recent repeat
+
+    A burst of ARPs tends to carry the same sender over and over.  The
+    table only needs to hear a given IP/MAC pairing once per
+    arp_dedup_time (a new MAC for an IP always gets through).
+    """
+    k = (arpp.protosrc, arpp.hwsrc)
+    now = self.now
+    seen = self._arp_seen
+    last = seen.get(k)
+    if last is not None and now - last < self.arp_dedup_time: return
+    if len(seen) >= self._arp_seen_max: seen.clear()
+    seen[k] = now
+    self.arp_table.rx_arp(arpp)
+
   def _rx_arp_reply (self, packet, arpp):
     if arpp.opcode != arpp.REPLY: return False
-    self.arp_table.rx_arp_reply(arpp)
+    self._arp_table_rx(arpp)
 
   def _rx_arp_request (self, packet, arpp):
     netdev = packet.rx_dev
@@ -591,7 +802,7 @@ class IPStack (object):
     if arpp.protolen != 4: return False
     if not netdev.has_ip_addr(arpp.protodst): return False
 
-    self.arp_table.rx_arp(arpp)
+    self._arp_table_rx(arpp)
 
     #TODO: proxy ARP / respond for other interfaces?
     if netdev.ip_addr != arpp.protodst: return False
@@ -636,6 +847,7 @@ class IPStack (object):
     ns = self._next_sniffer
     self._next_sniffer += 1
     self._sniffers[ns] = sniffer
+    self._sniffers_snapshot = tuple(self._sniffers.items())
     return ns
 
   def remove_sniffer (self, sniffer):
@@ -652,9 +864,10 @@ class IPStack (object):
         if s is sniffer:
           del self._sniffers[k]
           break
+    self._sniffers_snapshot = tuple(self._sniffers.items())
 
   def add_packet_capture (self, devs, handler, rx=True, tx=False,
-                          ip_only=False, eth_only=False):
+                          ip_only=False, eth_only=False, protocol=None):
     """
     Sets up packet capture on one or more devices
 
@@ -666,6 +879,9 @@ class IPStack (object):
     only is the default.
     You can limit to capturing only IP or Ethernet packets.  By default, you
     get both.
+    If protocol is set to "tcp", "udp", or "icmp", only packets of that
+    protocol are captured, and handler is called as handler(event, l4) where
+    l4 is the already-parsed transport layer (saving you a find()).
 
     You can pass the return value to remove_packet_capture() to turn off
     capture.
@@ -682,6 +898,9 @@ class IPStack (object):
 
     if isinstance(devs, str): devs = self.get_netdevs(devs)
 
+    if protocol is not None:
+      handler = self._make_protocol_capture_handler(handler, protocol)
+
     result = []
 
     for dev in devs:
@@ -696,6 +915,28 @@ class IPStack (object):
 
     return result
 
+  def _make_protocol_capture_handler (self, handler, protocol):
+    """
+    Wraps a capture handler so that it only sees one IP protocol
+
+    See add_packet_capture().
+    """
+    protocol_number,protocol_class = l4_protocols[protocol]
+    ipv4 = pkt.ipv4
+
+    def protocol_handler (event):
+      p = event.parsed
+      if p is None: return
+      if type(p) is not ipv4:
+        p = p.next # Ethernet
+        if type(p) is not ipv4: return
+      if p.protocol != protocol_number: return
+      l4 = p.next
+      if type(l4) is not protocol_class: return # e.g., a fragment
+      handler(event, l4)
+
+    return protocol_handler
+
   def remove_packet_capture (self, caplist):
     """
     Remove packet captures
@@ -710,7 +951,8 @@ class IPStack (object):
 
     dead_snoop = None
     sniff_eat = False
-    for k,v in self._sniffers.items():
+    # Iterate a snapshot so sniffers can be added and removed meanwhile
+    for k,v in self._sniffers_snapshot:
       r = v(p)
       if r and self.SNIFF_REMOVE:
         if dead_snoop is None: dead_snoop = []
@@ -721,7 +963,8 @@ class IPStack (object):
     if dead_snoop:
       self.log.debug("%s self-removing packet sniffer(s) removed", len(dead_snoop))
       for snoop in dead_snoop:
-        del self._sniffers[snoop]
+        self._sniffers.pop(snoop, None) # May have removed itself too
+      self._sniffers_snapshot = tuple(self._sniffers.items())
     if sniff_eat: return
 
     if p.eth:
@@ -735,7 +978,7 @@ class IPStack (object):
         return
 
     if p.ipv4:
-      if p.ipv4.srcip.is_broadcast or p.ipv4.srcip.is_multicast:
+      if _is_bcast_or_mcast(p.ipv4.srcip):
         # Suspicious!
         self.log.warn("Dropping IPv4 packet with src=%s", p.ipv4.srcip)
         return
@@ -757,12 +1000,12 @@ class IPStack (object):
         else:
           # Try all the other devices.  Should we only do this if some
           # flag is set?
-          for dev in self.netdevs.values():
-            if dev.has_ip_addr(p.ipv4.dstip):
-              # Local delivery
-              #FIXME: Use a local route?
-              self._local_rx(dev, p)
-              return
+          dev = self._local_ips.get(p.ipv4.dstip)
+          if dev is not None:
+            # Local delivery
+            #FIXME: Use a local route?
+            self._local_rx(dev, p)
+            return
 
       # Maybe forward it?
       if self.enable_ip_forward:
@@ -775,11 +1018,14 @@ class IPStack (object):
         p.ipv4.ttl -= 1
         if p.ipv4.ttl <= 0:
           self.log.warn("IP packet TTL expired")
-          if p.ipv4.dstip.is_broadcast or p.ipv4.dstip.is_multicast:
+          if _is_bcast_or_mcast(p.ipv4.dstip):
             # No ICMP for these
             return
-          tep = pkt.time_exceed()
-          tep.payload = p.ipv4
+          # Like the unreachable in send_to_dev(), just quote the header and
+          # 8 bytes rather than the whole packet.  (Building these fresh is
+          # cheaper than copy.copy()ing templates of them, as it happens.)
+          tep = pkt.time_exceeded()
+          tep.payload = p.ipv4.pack()[:p.ipv4.hl * 4 + 8]
           icmpp = pkt.icmp(type = pkt.TYPE_TIME_EXCEED, code = 0)
           icmpp.payload = tep
           ipp = pkt.ipv4(srcip = p.ipv4.dstip, dstip = p.ipv4.srcip)
@@ -845,26 +1091,31 @@ class IPStack (object):
       #FIXME: We currently copy all options to subsequent fragments.  We
       #       should actually only copy them if the high bit in the
       #       option type field is set.
-      payload = p.ipv4.payload.pack()
-      ipraw = p.ipv4.pack()
+      payload = p.ipv4.payload
+      if not isinstance(payload, bytes): payload = payload.pack()
       payload_size = (out_dev.mtu - p.ipv4.hl * 4) & ~7
       if payload_size == 0:
         self.log.error("Fragment payload size would be zero")
         return
+      # Slice parts out of a memoryview rather than repeatedly chopping the
+      # front off of payload (which copies the whole remainder each time),
+      # and give each fragment a shallow copy of the header rather than
+      # parsing the whole original packet again.
+      mv = memoryview(payload)
+      total = len(mv)
       frags = 0
       offset = 0
-      while payload:
-        part = payload[:payload_size]
-        payload = payload[payload_size:]
+      while offset < total:
+        part = bytes(mv[offset:offset+payload_size])
         pp = self.new_packet()
-        pp.ipv4 = pkt.ipv4(raw=ipraw)
+        pp.ipv4 = copy.copy(p.ipv4)
         pp.ipv4.frag = offset // 8
-        if payload:
+        offset += len(part)
+        if offset < total:
           pp.ipv4.flags |= pp.ipv4.MF_FLAG
         pp.ipv4.payload = part
         self.send(pp, set_src)
         frags += 1
-        offset += len(part)
       self.log.debug("Split packet into %s fragments", frags)
       return
 
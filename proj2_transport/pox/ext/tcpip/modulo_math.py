@@ -23,8 +23,11 @@ the expected wraparound behavior, you'd do:
 """
 
 import operator
+from functools import partial
 
 class DeferredOp (object):
+  __slots__ = ('f',)
+
   def __init__ (self, f):
     self.f = f
 
@@ -33,8 +36,17 @@ class DeferredOp (object):
 
 
 class U32BinaryOperator (object):
+  __slots__ = ('name', 'op')
+
+  def __init__ (self, name, op):
+    self.name = name
+    self.op = op
+
+  def __repr__ (self):
+    return "|%s|" % (self.name,)
+
   def __ror__ (self, other):
-    return DeferredOp(lambda o: self.op(other, o))
+    return DeferredOp(partial(self.op, other))
 
 
 U32_MASK = 0xFFffFFff
@@ -42,25 +54,66 @@ U32_MASK = 0xFFffFFff
 def u32_binary_op (f):
   return lambda a,b: f(a & U32_MASK, b & U32_MASK) & U32_MASK
 
-def _make_u32_binary_op (name, op):
-  c = type(name, (U32BinaryOperator,), dict(op=staticmethod(u32_binary_op(op))))
-  globals()[name] = c()
-
-def _MLT (s, t):
-  return 0 < (t |MINUS| s) < 0x80000000
-
-def _MGT (t, s):
-  return 0 < (t |MINUS| s) < 0x80000000
-
-def _MLE (s, t):
-  return 0 <= (t |MINUS| s) < 0x80000000
-
-def _MGE (t, s):
-  return 0 <= (t |MINUS| s) < 0x80000000
-
-_make_u32_binary_op("PLUS", operator.add)
-_make_u32_binary_op("MINUS", operator.sub)
-_make_u32_binary_op("TIMES", operator.mul)
+def _make_u32_binary_op (name, op, masked=False):
+  """
+  Makes a |name| operator
+
+  If op already masks its result (and doesn't care whether its inputs are
+  masked), pass masked=True to skip the extra masking.
+  """
+  if not masked: op = u32_binary_op(op)
+  globals()[name] = U32BinaryOperator(name, op)
+
+# Plain function versions of the hot operators.  These do the same thing
+# as the |OP| forms without building a DeferredOp and a closure per use,
+# so use them in per-packet code.  (Masking the operands first, as
+# u32_binary_op() does, makes no difference to the results here.)
+
+def u32_plus (a, b):
+  return (a + b) & U32_MASK
+
+def u32_minus (a, b):
+  return (a - b) & U32_MASK
+
+def u32_times (a, b):
+  return (a * b) & U32_MASK
+
+def u32_eq (a, b):
+  return (a & U32_MASK) == (b & U32_MASK)
+
+def u32_ne (a, b):
+  return (a & U32_MASK) != (b & U32_MASK)
+
+def u32_le (a, b):
+  return (a & U32_MASK) <= (b & U32_MASK)
+
+def u32_mlt (s, t):
+  """
+  s < t in sequence space (i.e., modulo 2**32)
+  """
+  return 0 < ((t - s) & U32_MASK) < 0x80000000
+
+def u32_mgt (t, s):
+  """
+  t > s in sequence space (i.e., modulo 2**32)
+  """
+  return 0 < ((t - s) & U32_MASK) < 0x80000000
+
+def u32_mle (s, t):
+  """
+  s <= t in sequence space (i.e., modulo 2**32)
+  """
+  return 0 <= ((t - s) & U32_MASK) < 0x80000000
+
+def u32_mge (t, s):
+  """
+  t >= s in sequence space (i.e., modulo 2**32)
+  """
+  return 0 <= ((t - s) & U32_MASK) < 0x80000000
+
+_make_u32_binary_op("PLUS", u32_plus, masked=True)
+_make_u32_binary_op("MINUS", u32_minus, masked=True)
+_make_u32_binary_op("TIMES", u32_times, masked=True)
 _make_u32_binary_op("DIVIDED_BY", operator.truediv)
 _make_u32_binary_op("GT", operator.gt)
 _make_u32_binary_op("GE", operator.ge)
@@ -68,7 +121,7 @@ _make_u32_binary_op("LT", operator.lt)
 _make_u32_binary_op("LE", operator.le)
 _make_u32_binary_op("EQ", operator.eq)
 _make_u32_binary_op("NE", operator.ne)
-_make_u32_binary_op("MGT", _MGT)
-_make_u32_binary_op("MGE", _MGE)
-_make_u32_binary_op("MLT", _MLT)
-_make_u32_binary_op("MLE", _MLE)
+_make_u32_binary_op("MGT", u32_mgt)
+_make_u32_binary_op("MGE", u32_mge)
+_make_u32_binary_op("MLT", u32_mlt)
+_make_u32_binary_op("MLE", u32_mle)
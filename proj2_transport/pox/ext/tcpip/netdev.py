@@ -37,6 +37,16 @@ log = core.getLogger()
 
 
 
+# Transport protocols that captures and drop conditions can be limited to
+# name -> (IP protocol number, packet class)
+l4_protocols = {
+  "tcp" : (pkt.ipv4.TCP_PROTOCOL, pkt.tcp),
+  "udp" : (pkt.ipv4.UDP_PROTOCOL, pkt.udp),
+  "icmp" : (pkt.ipv4.ICMP_PROTOCOL, pkt.icmp),
+}
+
+
+
 class CapturedPacketBase (Event):
   """
   Event which is fired when sniffing packets on a netdev
@@ -82,7 +92,7 @@ class CapturedPacketTX (CapturedPacketBase):
 
 class NetDev (EventMixin):
   name = None
-  ip_addr = None
+  _ip_addr = None
   stack = None
 
   is_l2 = False
@@ -110,6 +120,17 @@ class NetDev (EventMixin):
     self.enable_tx = v
     self.enable_rx = v
 
+  @property
+  def ip_addr (self):
+    return self._ip_addr
+
+  @ip_addr.setter
+  def ip_addr (self, addr):
+    old = self._ip_addr
+    self._ip_addr = addr
+    if self.stack is not None:
+      self.stack._ip_addr_changed(self, old, addr)
+
   def has_ip_addr (self, addr):
     return self.ip_addr == addr
 
@@ -35,11 +35,15 @@ log = core.getLogger()
 
 class PCapper (object):
   _pcap = None
+  _file = None
+  buffer_size = 1024 * 1024 # Bytes of capture held before hitting the disk
+
   def __init__ (self, name, log, basename, topo=None):
     self.name = name
     self.basename = basename
-    self.topo = None
+    self.topo = topo
     self.log = log
+    self._write = self._open_and_write
 
   def _init_pcap (self):
     if self.topo is None:
@@ -48,16 +52,32 @@ class PCapper (object):
     if fn is None: fn = self.topo.timestamp
     fn = "%s_%s.pcap" % (fn, self.name)
     self.log.debug("Writing to %s", fn)
-    self._pcap = PCapRawWriter(open(fn, "wb"), True, ip=True)
+    # Flushing every packet costs a write() per packet.  Let the file
+    # batch them up instead and make sure it's written out on the way down.
+    self._file = open(fn, "wb", self.buffer_size)
+    self._pcap = PCapRawWriter(self._file, False, ip=True)
+    core.add_listener(self._handle_GoingDownEvent)
+
+  def _handle_GoingDownEvent (self, event):
+    self.flush()
+
+  def flush (self):
+    if self._file is not None:
+      self._file.flush()
 
   def tx_capture_proc (self, *args):
     self.rx_capture_proc(*args)
 
+  def _open_and_write (self, raw, time):
+    # The file isn't opened until there's something to put in it (by which
+    # time the topology has its timestamp).  After that, write directly.
+    self._init_pcap()
+    self._write = self._pcap.write
+    self._write(raw, time=time)
+
   def rx_capture_proc (self, dev, is_rx, raw, parsed):
-    if self._pcap is None: self._init_pcap()
     # Currently this is hardwired to only write IP (not Ethernet)
-    raw = raw if raw else parsed.pack()
-    self._pcap.write(raw, time=self.topo.now)
+    self._write(raw, time=self.topo.now)
 
 
 
@@ -68,7 +88,7 @@ _all_nodes = [False,False]
 
 
 def _add_pcap (node, rx, tx):
-  pcap = PCapper(node.name, node.log, _basename)
+  pcap = PCapper(node.name, node.log, _basename, node.topo)
 
   for dev in node.stack.netdevs.values():
     # Currently only SimNetDevs supported
@@ -26,13 +26,26 @@ determine which packets to drop.  See the wire documentation for more
 on those (they're very similar for both queues and wires).
 """
 
+from collections import deque
+
+
+# Square roots of small drop counts for CoDel's control law.  These are
+# computed with ** just like the fallback so results are the same either way.
+_sqrt_table = [i ** 0.5 for i in range(4096)]
+
 
 class Queue (object):
   topo = None
   src = None # Node
   dst = None # Node
 
-  def enqueue (self, packet):
+  def enqueue (self, packet, size=None):
+    """
+    Queue a packet for transmission
+
+    size is the packet's length on the wire.  Callers which already know it
+    should pass it in; otherwise it's len(packet), which may mean packing.
+    """
     raise NotImplementedError()
 
   def __len__ (self):
@@ -48,12 +61,13 @@ class SimpleQueue (Queue):
   queue = None
   _busy = False # Is a packet currently being transmitted?
   _idle_at = 0 # Last time the queue went idle (use idle_at property!)
+  _wire = None # Cached outgoing wire (use _get_wire()!)
 
   _max_queue = 0
 
   def __init__ (self, max_size=None):
     self.max_size = max_size if max_size is not None else self.max_size
-    self.queue = [] #TODO: Use a deque instead
+    self.queue = deque()
     self.drop_conditions = []
 
   @property
@@ -74,18 +88,35 @@ class SimpleQueue (Queue):
       if d(self, packet): return True
     return False
 
-  def enqueue (self, packet):
+  def enqueue (self, packet, size=None):
     if self._check_drop(packet): return
 
     if (self.max_size is not None) and (len(self.queue) >= self.max_size):
       self._drop_warning()
       return
 
-    self.queue.append(packet)
+    if size is None: size = len(packet)
+    self.queue.append((size,packet))
     self._start_transmit()
 
+  def _get_wire (self):
+    """
+    Returns the outgoing wire
+
+    The topology resets the cached one if set_wire() replaces it.
+    """
+    wire = self._wire
+    if wire is None:
+      wire = self._wire = self.topo.get_wire(self.src,self.dst)
+    return wire
+
   def _queue_pop (self):
-    return self.queue.pop(0)
+    """
+    Returns the next queue entry to transmit, or None
+
+    Entries are tuples which start with (size,packet,...).
+    """
+    return self.queue.popleft()
 
   def _on_queue_dry (self):
     """
@@ -98,12 +129,16 @@ class SimpleQueue (Queue):
     if not self.queue:
       self._on_queue_dry()
       return
-    packet = self._queue_pop()
-    if packet is None:
+    entry = self._queue_pop()
+    if entry is None:
       assert not self.queue
       self._on_queue_dry()
       return # Allow _queue_pop to run dry
-    wire = self.topo.get_wire(self.src,self.dst)
+    # The size was measured on enqueue; packing again just to get it is
+    # expensive.
+    size = entry[0]
+    packet = entry[1]
+    wire = self._get_wire()
     if wire is None:
       self.src.warn("No outgoing wire to %s", self.dst)
       return
@@ -111,7 +146,7 @@ class SimpleQueue (Queue):
     if len(self.queue) > self._max_queue:
       self._max_queue = len(self.queue)
       self.src.log.info("Max queue occupancy: %s", self._max_queue)
-    trans_time = (len(packet.pack()) * 8.0) / wire.rate
+    trans_time = (size * 8.0) / wire.rate
     if trans_time <= 0:
       # Don't even bother with the timer (probably only when rate=infinity)
       self._on_transmit_finish(packet)
@@ -123,8 +158,7 @@ class SimpleQueue (Queue):
     self._idle_at = self.topo.now
     self._start_transmit()
 
-    wire = self.topo.get_wire(self.src,self.dst)
-    wire.transmit(packet)
+    self._get_wire().transmit(packet)
 
   def _drop_warning (self):
     self.src.log.warn("Queue full -- dropping packet to %s", self.dst)
@@ -143,23 +177,29 @@ class SimpleByteQueue (SimpleQueue):
   _enqueued_bytes = 0
   max_size = 1460 * 30
 
-  def enqueue (self, packet):
+  def enqueue (self, packet, size=None):
     if self._check_drop(packet): return
 
-    size = len(packet)
+    if size is None: size = len(packet)
     if self.max_size is not None:
       if size+self._enqueued_bytes >= self.max_size:
         self._drop_warning()
         return
     self._enqueued_bytes += size
 
-    self.queue.append((size,packet))
+    self.queue.append(self._make_entry(size, packet))
     self._start_transmit()
 
+  def _make_entry (self, size, packet):
+    """
+    Returns the queue entry for an accepted packet (see _queue_pop())
+    """
+    return (size,packet)
+
   def _queue_pop (self):
-    size,packet = self.queue.pop(0)
-    self._enqueued_bytes -= size
-    return packet
+    entry = self.queue.popleft()
+    self._enqueued_bytes -= entry[0]
+    return entry
 
 
 
@@ -194,19 +234,10 @@ class CoDelQueue (SimpleByteQueue):
     # This is the name used by CoDel
     return self.src.mtu
 
-  def enqueue (self, packet):
-    # Only real difference here is that we put a TS in the queue.
-    if self._check_drop(packet): return
-
-    size = len(packet)
-    if self.max_size is not None:
-      if size+self._enqueued_bytes >= self.max_size:
-        self._drop_warning()
-        return
-    self._enqueued_bytes += size
-
-    self.queue.append((size,self.src.stack.now,packet))
-    self._start_transmit()
+  def _make_entry (self, size, packet):
+    # Only real difference on enqueue is that we put a TS in the queue.  It
+    # goes at the end so that entries can be handed back as-is by _queue_pop().
+    return (size,packet,self.src.stack.now)
 
   def _on_queue_dry (self):
     super(CoDelQueue,self)._on_queue_dry()
@@ -224,14 +255,22 @@ class CoDelQueue (SimpleByteQueue):
     if self._dropping:
       if not ok_to_drop:
         self._dropping = False
-      while now > self._drop_next and self._dropping:
-        # Drop p
-        self._count += 1
-        ok_to_drop,p = self._do_dequeue(now)
-        if not ok_to_drop:
-          self._dropping = False
-        else:
-          self._drop_next = self._control_law(self._drop_next, self._count)
+      else:
+        # This can drop a run of packets, so work on locals
+        do_dequeue = self._do_dequeue
+        control_law = self._control_law
+        count = self._count
+        drop_next = self._drop_next
+        while now > drop_next:
+          # Drop p
+          count += 1
+          ok_to_drop,p = do_dequeue(now)
+          if not ok_to_drop:
+            self._dropping = False
+            break
+          drop_next = control_law(drop_next, count)
+        self._count = count
+        self._drop_next = drop_next
     elif ok_to_drop:
       # Drop p
       ok_to_drop,p = self._do_dequeue(now)
@@ -248,21 +287,27 @@ class CoDelQueue (SimpleByteQueue):
     return p
 
   def _do_dequeue (self, now):
-    if not self.queue:
+    """
+    Returns (ok_to_drop, queue entry or None)
+    """
+    queue = self.queue
+    if not queue:
       self._first_above_time = 0
       return False,None
-    ok_to_drop = False
-    size,ts,packet = self.queue.pop(0)
-    self._enqueued_bytes -= size
-    sojourn_time = now - ts
-    if sojourn_time < self.TARGET or self._enqueued_bytes <= self._maxpacket:
+    entry = queue.popleft()
+    enqueued_bytes = self._enqueued_bytes - entry[0]
+    self._enqueued_bytes = enqueued_bytes
+    sojourn_time = now - entry[2]
+    if sojourn_time < self.TARGET or enqueued_bytes <= self._maxpacket:
       self._first_above_time = 0
-    else:
-      if self._first_above_time == 0:
-        self._first_above_time = now + self.INTERVAL
-      elif now >= self._first_above_time:
-        ok_to_drop = True
-    return ok_to_drop,packet
+      return False,entry
+    first_above_time = self._first_above_time
+    if first_above_time == 0:
+      self._first_above_time = now + self.INTERVAL
+      return False,entry
+    return now >= first_above_time,entry
 
   def _control_law (self, t, count):
+    if count < 4096:
+      return t + self.INTERVAL / _sqrt_table[count]
     return t + self.INTERVAL / (count ** 0.5)
@@ -59,6 +59,7 @@ class SimNetDev (NetDev):
   #TODO: Remove this capture proc stuff and replace with new
   #      CapturedPacket events?  The main difference at the
   #      moment is that the capture_procs can kill packets.
+  # The capture procs are always passed raw as well as parsed.
   tx_capture_proc = None # f(dev,is_rx,raw,parsed)
   rx_capture_proc = None # f(dev,is_rx,raw,parsed)
 
@@ -87,7 +88,7 @@ class SimNetDev (NetDev):
       return
     if self.tx_capture_proc: self.tx_capture_proc(self,False,raw,ip)
     self.raiseEvent(CapturedPacketTX, self, ip, raw, True)
-    queue.enqueue(ip)
+    queue.enqueue(ip, len(raw))
 
   def rx (self, packet, src):
     """
@@ -98,8 +99,12 @@ class SimNetDev (NetDev):
       p.rx_dev = self
       p.ipv4 = packet
       p.break_payload()
-      if self.rx_capture_proc: self.rx_capture_proc(self,True,None,packet)
-      self.raiseEvent(CapturedPacketRX, self, packet, None, True)
+      raw = None
+      if self.rx_capture_proc:
+        # Pack once here so the event can share it with the capture
+        raw = packet.pack()
+        self.rx_capture_proc(self,True,raw,packet)
+      self.raiseEvent(CapturedPacketRX, self, packet, raw, True)
       self.node._do_simnetdev_rx(p)
 
   @classmethod
@@ -153,6 +158,7 @@ class TopologyBase (object):
 
   def __init__ (self):
     self.nodes = set()
+    self._nodes_by_name = {} # name -> Node
     self.queues = {} # (src_node,dst_node) -> Queue
     self.wires = {} # (src_node,dst_node) -> Wire
 
@@ -163,9 +169,7 @@ class TopologyBase (object):
     return make_factory(self, *args, **kw)
 
   def get_node (self, name):
-    for n in self.nodes:
-      if n.name == name: return n
-    return n
+    return self._nodes_by_name.get(name)
 
   def _do_routing (self, force=False):
     # Hilariously bad shortest path routing
@@ -184,8 +188,7 @@ class TopologyBase (object):
       for r in routes:
         if not r.exportable: continue
 
-        # This next line is ugly...
-        r2 = drt.tables[r.size].get(r.prefix)
+        r2 = drt.get(r.prefix, r.size)
         metric = r.metric + wire.max_latency
         if metric == r.metric: metric += Epsilon
         if not r2 or (r2 and r2[0].metric > metric):
@@ -236,6 +239,7 @@ class TopologyBase (object):
     If s is specified, wire n to s using default wire/queue
     """
     self.nodes.add(n)
+    self._nodes_by_name[n.name] = n
     n.topo = self
 
     #FIXME: This next bit of initializing stack stuff really doesn't belong
@@ -347,6 +351,11 @@ class TopologyBase (object):
       self.wires.pop((n2,n1), None) # Is this necessary?
       self.wires[n2,n1] = factory2
 
+    # Queues cache their outgoing wire
+    for k in ((n1,n2),(n2,n1)):
+      q = self.queues.get(k)
+      if q is not None: q._wire = None
+
     self._do_routing()
 
     return (factory1,factory2)
@@ -382,6 +391,10 @@ class TopologyBase (object):
     raise NotImplementedError()
   def set_timer_at (self, t, f, *args, **kw):
     raise NotImplementedError()
+  def set_timer_in_cancellable (self, t, f, *args, **kw):
+    raise NotImplementedError()
+  def set_timer_at_cancellable (self, t, f, *args, **kw):
+    raise NotImplementedError()
   @property
   def now (self):
     raise NotImplementedError()
@@ -397,6 +410,12 @@ class Topology (TopologyBase):
   def set_timer_at (_self, *_args, **_kw):
     return _self.time.set_timer_at(*_args,**_kw)
 
+  def set_timer_in_cancellable (_self, *_args, **_kw):
+    return _self.time.set_timer_in_cancellable(*_args,**_kw)
+
+  def set_timer_at_cancellable (_self, *_args, **_kw):
+    return _self.time.set_timer_at_cancellable(*_args,**_kw)
+
   def resleep (self, t):
     return self.time.resleep(t)
 
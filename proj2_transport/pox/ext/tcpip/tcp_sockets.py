@@ -104,6 +104,7 @@ import pox.lib.packet as pkt
 
 import hashlib
 import random
+import logging
 import collections
 import inspect
 from socket import SHUT_RD, SHUT_WR, SHUT_RDWR
@@ -167,15 +168,15 @@ class Window (object):
     # RFC 793 S3.3
     if seg.len == 0 and self.wnd == 0:
       return seg.seq == self.nxt
-    if seg.len == 0 and self.wnd |MGT| 0:
-      if ((self.nxt |MLE| seg.seq) and (seg.seq |MLT| (self.nxt |PLUS| self.wnd))): return True
+    if seg.len == 0 and u32_mgt(self.wnd, 0):
+      if (u32_mle(self.nxt, seg.seq) and u32_mlt(seg.seq, u32_plus(self.nxt, self.wnd))): return True
       return False
     if seg.len > 0 and self.wnd == 0:
       return False
     if seg.len > 0 and self.wnd > 0:
-      if ((self.nxt |MLE| seg.seq) and (seg.seq |MLT| (self.nxt |PLUS| self.wnd))): return True
-      rhs = seg.seq |PLUS| (seg.len-1)
-      if ((self.nxt |MLE| rhs) and (rhs |MLT| (self.nxt |PLUS| self.wnd))): return True
+      if (u32_mle(self.nxt, seg.seq) and u32_mlt(seg.seq, u32_plus(self.nxt, self.wnd))): return True
+      rhs = u32_plus(seg.seq, seg.len-1)
+      if (u32_mle(self.nxt, rhs) and u32_mlt(rhs, u32_plus(self.nxt, self.wnd))): return True
       return False
     return False
 
@@ -188,7 +189,7 @@ class TXWindow (Window):
   def __init__ (self):
     # RFC 793 p66
     self.isn = self.generate_isn()
-    self.nxt = self.isn |PLUS| 1
+    self.nxt = u32_plus(self.isn, 1)
     self.una = self.isn
 
   def generate_isn (self):
@@ -200,9 +201,9 @@ class TXWindow (Window):
     How many bytes can we send?
     """
     # Hmmm... what about just .wnd?
-    re = (self.una |PLUS| self.wnd)
-    if re |MLT| self.nxt: return 0
-    return re |MINUS| self.nxt
+    re = u32_plus(self.una, self.wnd)
+    if u32_mlt(re, self.nxt): return 0
+    return u32_minus(re, self.nxt)
 
   def una_advance (self, ackno):
     self.una = ackno
@@ -242,12 +243,12 @@ class PacketQueue (list):
       self.append(p)
       return
 
-    if p.tcp.seq |MLT| self[0].tcp.seq:
+    if u32_mlt(p.tcp.seq, self[0].tcp.seq):
       self.insert(0, p)
       return
 
     self.append(p)
-    if p.tcp.seq |MLT| self[-2].tcp.seq:
+    if u32_mlt(p.tcp.seq, self[-2].tcp.seq):
       self.sort(key=self._get_seqno)
 
   def pop (self, index=None):
@@ -264,6 +265,35 @@ class PacketQueue (list):
     del self[-count:]
     return r
 
+  def find_acked (self, ackno):
+    """
+    Finds the packet an ACK of ackno ends in
+
+    That is, it returns the index of the packet p for which
+    p.tcp.seq < ackno <= p.tcp.seq + tcplen(p.tcp), or None if there isn't
+    one.  Since we're sorted, we do this with a binary search.  In order to
+    deal with wraparound, sequence numbers are taken relative to the first
+    packet.
+    """
+    if not self: return None
+    base = self[0].tcp.seq
+    target = u32_minus(ackno, base)
+    lo = 0
+    hi = len(self)
+    while lo < hi:
+      # Looking for the first packet which ends at or after ackno
+      mid = (lo + hi) // 2
+      tp = self[mid].tcp
+      if u32_minus(tp.seq, base) + tcplen(tp) < target:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo == len(self): return None
+    tp = self[lo].tcp
+    start = u32_minus(tp.seq, base)
+    if start < target <= start + tcplen(tp): return lo
+    return None
+
   @staticmethod
   def _get_seqno (p):
     return p.tcp.seq
@@ -459,7 +489,7 @@ class Socket (object):
 
     if data:
       p.tcp.payload = data
-      self.snd.nxt = self.snd.nxt |PLUS| len(data)
+      self.snd.nxt = u32_plus(self.snd.nxt, len(data))
 
     if self.state is LISTEN:
       pass
@@ -470,7 +500,8 @@ class Socket (object):
       p.tcp.win = self._get_wnd_advertisement()
       self._last_wnd_advertisement = p.tcp.win
 
-    if data is None: self.log.info("CRAFTED PACKET WITH ACK %s", self.rcv.nxt|MINUS|self.rcv.isn) #XXX
+    if data is None and self.log.isEnabledFor(logging.INFO):
+      self.log.info("CRAFTED PACKET WITH ACK %s", u32_minus(self.rcv.nxt, self.rcv.isn)) #XXX
     return p
 
 
@@ -536,7 +567,7 @@ class Socket (object):
     if not (self.tx_data or self.retx_queue): return False # Either or only tx?
     if seg.payload: return False
     if seg.SYN or seg.FIN: return False
-    if seg.ack |NE| self.snd.una: return False
+    if u32_ne(seg.ack, self.snd.una): return False
     if self._read_win(seg) != self.snd.wnd: return False
     return True
 
@@ -958,7 +989,7 @@ class Socket (object):
 
     # RFC 793 p66
     s.rcv.isn = tp.seq
-    s.rcv.nxt = tp.seq |PLUS| 1
+    s.rcv.nxt = u32_plus(tp.seq, 1)
 
     rp = s._new_packet(syn=True)
     rp.tcp.seq = s.snd.isn
@@ -1004,7 +1035,7 @@ class Socket (object):
       # when we're *sending*, so isn't this more direct?
       if self.stack.now - self.last_send_ts > self.rto:
         self.log.debug("Reset cwnd = RW")
-        self.cwnd = self.RW
+        self._set_cwnd(self.RW)
         self.last_send_ts = None
 
     def get_send_size (limited_tx=True):
@@ -1017,8 +1048,10 @@ class Socket (object):
         cwnd += delta
       ##window_size = min(self.snd.window_size, cwnd)
       window_size = min(self.snd.wnd, cwnd)
-      max_size = window_size - self.flight_size
-      self.log.debug("WND rwnd:%s cwnd:%s/%s wnd:%s flt:%s max:%s dupack:%s", self.snd.wnd, self.cwnd,cwnd, window_size, self.flight_size, max_size if max_size > 0 else 0, self._dup_ack_count) #XXX
+      flight_size = self.flight_size
+      max_size = window_size - flight_size
+      if self.log.isEnabledFor(logging.DEBUG):
+        self.log.debug("WND rwnd:%s cwnd:%s/%s wnd:%s flt:%s max:%s dupack:%s", self.snd.wnd, self.cwnd,cwnd, window_size, flight_size, max_size if max_size > 0 else 0, self._dup_ack_count) #XXX
       if max_size <= 0: return 0 # Already too much in flight
       return min(len(self.tx_data), max_size)
 
@@ -1051,9 +1084,13 @@ class Socket (object):
       self._tx(p)
       count += 1
 
-    if count:
+    if not self.tx_data:
+      # Drained, so a pending FIN may be able to go now
+      self._can_send_fin_now = self._fin_pending and not self._fin_sent
+
+    if count and self.log.isEnabledFor(logging.INFO):
       self.log.debug("Sent %s packet(s) (%s payload bytes, %s remain)", count, total_size, len(self.tx_data))
-      self.log.info("SENT TOT:%s  NEW:%s  FLT:%s BUF:%s", p.tcp.seq|MINUS|self.snd.isn, total_size, self.flight_size, len(self.tx_data))
+      self.log.info("SENT TOT:%s  NEW:%s  FLT:%s BUF:%s", u32_minus(p.tcp.seq, self.snd.isn), total_size, self.flight_size, len(self.tx_data))
     return count
 
 
@@ -1089,7 +1126,7 @@ class Socket (object):
       if self._retx_start + self.rto > self.stack.now: return # Not expired yet
 
     if from_timer:
-      self._recover = self.snd.nxt |MINUS| 1
+      self._recover = u32_minus(self.snd.nxt, 1)
       if self._in_fast_recovery:
         self._exit_frr()
 
@@ -1105,15 +1142,15 @@ class Socket (object):
     start_packet = 0
     if seqno:
       for i,p in enumerate(self.retx_queue):
-        if p.tcp.seq |MGE| seqno:
-          if (p.tcp.seq |PLUS| tcplen(p.tcp)) |MGT| seqno:
+        if u32_mge(p.tcp.seq, seqno):
+          if u32_mgt(u32_plus(p.tcp.seq, tcplen(p.tcp)), seqno):
             self.log.info("Fast ReTX packet #%s (%s, %s)", i, p.tcp.seq, seqno)
             start_packet = i
             break
       else:
-        self.log.warn("No packet %i (%i) for fast retx", seqno, seqno|MINUS|self.snd.isn)
+        self.log.warn("No packet %i (%i) for fast retx", seqno, u32_minus(seqno, self.snd.isn))
         for i,p in enumerate(self.retx_queue):
-          self.log.warn("> %s %s", p.tcp.seq, p.tcp.seq|MINUS|self.snd.isn)
+          self.log.warn("> %s %s", p.tcp.seq, u32_minus(p.tcp.seq, self.snd.isn))
 
     sent = 0
     for which in range(maximum):
@@ -1168,7 +1205,7 @@ class Socket (object):
         # Hmm... are there other cases we need to do this?
         self.rto = 3
 
-      self.log.debug("ReTX seq:%s len:%s rto:%s delta_time:%s", p.tcp.seq|MINUS|self.snd.isn,
+      self.log.debug("ReTX seq:%s len:%s rto:%s delta_time:%s", u32_minus(p.tcp.seq, self.snd.isn),
                      0 if not p.tcp.payload else len(p.tcp.payload),
                      self.rto,
                      np.retx_ts - np.tx_ts)
@@ -1225,7 +1262,7 @@ class Socket (object):
       if p.tcp.payload: length += len(p.tcp.payload)
 
       partial = False
-      if seq |MLT| ack:
+      if u32_mlt(seq, ack):
         # Start of packet is ACKed
         partial = True
         #NOTE: Used to do RTT measurement here
@@ -1234,7 +1271,7 @@ class Socket (object):
       #print ( "(seq(%s)+length(%s) = %s) <= ack(%s) ? %s"
       #        % (seq,length,seq|PLUS|length,ack,(seq|PLUS|length)|MLE|ack) )
 
-      if (seq |PLUS| length) |MLE| ack:
+      if u32_mle(u32_plus(seq, length), ack):
         # Entire packet is acknowledged
         old += 1
       elif partial:
@@ -1242,11 +1279,11 @@ class Socket (object):
         # and keep the rest in the retx queue.
         # This is a bit tricky and it's quite possibly buggy.
         seg = p.tcp
-        acked_bytes = ack |MINUS| seq
+        acked_bytes = u32_minus(ack, seq)
         if seg.SYN:
           # We must have ACKed the SYN (since partial).  It's conceptually
           # at the start of the packet, so we acked 1 fewer bytes
-          acked_bytes = acked_bytes |MINUS| 1
+          acked_bytes = u32_minus(acked_bytes, 1)
           seg.SYN = False # Remove SYN
         # We don't mess with acked_bytes for the FIN because it conceptually
         # "comes after" the data. (RFC 793 p26 at the bottom)
@@ -1261,10 +1298,10 @@ class Socket (object):
         break
 
     if old: self.retx_queue.pop_head(old)
-    if old or len(self.retx_queue):
+    if (old or len(self.retx_queue)) and self.log.isEnabledFor(logging.DEBUG):
       self.log.debug("Removed %s segment(s) from ReTX queue (%s remain)",
                      old, len(self.retx_queue))
-      self.log.debug("ACK:%s", ack |MINUS| self.snd.isn)
+      self.log.debug("ACK:%s", u32_minus(ack, self.snd.isn))
 
   # -------------------------------------------------------------------------
 
@@ -1297,19 +1334,22 @@ class Socket (object):
     # This seems kind of ugly and maybe we can move these into the normal
     # rx path.
     if self.state not in (CLOSED, LISTEN, SYN_SENT):
-      lo = self.rcv.nxt|MINUS|(self.rcv.wnd // 2)
-      hi = self.rcv.nxt|PLUS|(self.rcv.wnd // 2)
-      if (packet.tcp.seq|MGE|lo) and (packet.tcp.seq|MLE|hi):
+      lo = u32_minus(self.rcv.nxt, self.rcv.wnd // 2)
+      hi = u32_plus(self.rcv.nxt, self.rcv.wnd // 2)
+      if u32_mge(packet.tcp.seq, lo) and u32_mle(packet.tcp.seq, hi):
+        seg = packet.tcp
         if self.use_ts_option:
-          self._process_timestamp(packet.tcp)
-        else:
-          self._maybe_update_rto(packet.tcp)
+          self._process_timestamp(seg)
+        elif seg.ACK and self.retx_queue and u32_mgt(seg.ack, self.snd.una):
+          # Only ACKs of new data can possibly yield an RTT sample
+          self._maybe_update_rto(seg)
 
     if self._rx_one(packet): return
 
-    while self.rx_queue and self.rx_queue[0].tcp.seq |LE| self.rcv.nxt:
+    while self.rx_queue and u32_le(self.rx_queue[0].tcp.seq, self.rcv.nxt):
       p = self.rx_queue.pop()
-      self.log.debug("RX queued packet (seq:%s nxt:%s)",p.tcp.seq|MINUS|self.rcv.isn,self.rcv.nxt|MINUS|self.rcv.isn)
+      if self.log.isEnabledFor(logging.DEBUG):
+        self.log.debug("RX queued packet (seq:%s nxt:%s)",u32_minus(p.tcp.seq, self.rcv.isn),u32_minus(self.rcv.nxt, self.rcv.isn))
       if self._rx_one(p): return
 
     self._maybe_send()
@@ -1353,7 +1393,7 @@ class Socket (object):
         rp.tcp.RST = True
         if not tp.ACK:
           rp.tcp.seq = 0
-          rp.tcp.ack = tp.seq |PLUS| tcplen(tp)
+          rp.tcp.ack = u32_plus(tp.seq, tcplen(tp))
           rp.tcp.ACK = True
         else:
           rp.tcp.seq = tp.ack
@@ -1389,7 +1429,7 @@ class Socket (object):
 
     ack_ok = False
     if packet.tcp.ACK: # first
-      if packet.tcp.ack |MLE| self.snd.isn or packet.tcp.ack |MGT| self.snd.nxt:
+      if u32_mle(packet.tcp.ack, self.snd.isn) or u32_mgt(packet.tcp.ack, self.snd.nxt):
         if packet.tcp.RST: return
         #TODO: Check that this works
         rp = self._new_packet()
@@ -1397,7 +1437,7 @@ class Socket (object):
         rp.tcp.seq = packet.tcp.ack
         self._tx(rp)
         return
-      if (self.snd.una |MLE| packet.tcp.ack) and (packet.tcp.ack |MLE| self.snd.nxt):
+      if u32_mle(self.snd.una, packet.tcp.ack) and u32_mle(packet.tcp.ack, self.snd.nxt):
         ack_ok = True
       else:
         self.log.warn("ACK unacceptable?") #FIXME
@@ -1411,7 +1451,7 @@ class Socket (object):
     # third - check security (ignored)
 
     if packet.tcp.SYN: # fourth (p68)
-      self.rcv.nxt = packet.tcp.seq |PLUS| 1
+      self.rcv.nxt = u32_plus(packet.tcp.seq, 1)
       self.rcv.isn = packet.tcp.seq
       if packet.tcp.ACK:
         self.snd_una_advance(packet.tcp.ack)
@@ -1419,7 +1459,7 @@ class Socket (object):
         #      segments from the retx queue here.  Since we haven't hit
         #      ESTABLISHED yet, there should never be any.
 
-      if self.snd.una |MGT| self.snd.isn:
+      if u32_mgt(self.snd.una, self.snd.isn):
         if self._establish(packet) is False:
           # Ack; abort!
           return
@@ -1468,7 +1508,8 @@ class Socket (object):
     rcv = self.rcv
     snd = self.snd
 
-    if len(seg.payload) > 1: self.log.warn("GOT SEQ %s", seg.seq|MINUS|self.rcv.isn)
+    if len(seg.payload) > 1 and self.log.isEnabledFor(logging.WARNING):
+      self.log.warn("GOT SEQ %s", u32_minus(seg.seq, self.rcv.isn))
 
 
     if not rcv.check_accept(seg):
@@ -1495,9 +1536,9 @@ class Socket (object):
       return
 
     #TODO: Move this block of stuff into Window?
-    if seg.seq |EQ| rcv.nxt:
+    if u32_eq(seg.seq, rcv.nxt):
       pass # Perfect
-    elif seg.seq |MLT| rcv.nxt:
+    elif u32_mlt(seg.seq, rcv.nxt):
       # Old sequence number (at least the start)
       # May contain new in-window data?  May just be a dup?
       # Can we just process as normal?  Let's try...
@@ -1507,8 +1548,9 @@ class Socket (object):
       # It's a packet from the future; queue for later.
       self.rx_queue.push(packet)
       self._set_ack_pending() # Send ACK per RFC 5681 p8
-      self.log.debug("Future packet queued for later (seq:%s nxt:%s)",
-                     seg.seq|MINUS|rcv.isn, rcv.nxt|MINUS|rcv.isn)
+      if self.log.isEnabledFor(logging.DEBUG):
+        self.log.debug("Future packet queued for later (seq:%s nxt:%s)",
+                       u32_minus(seg.seq, rcv.isn), u32_minus(rcv.nxt, rcv.isn))
       return
 
     if seg.RST:
@@ -1564,7 +1606,7 @@ class Socket (object):
     if not seg.ACK: return
 
     if self.state is SYN_RECEIVED:
-      if (snd.una |MLE| seg.ack) and (seg.ack |MLE| snd.nxt):
+      if u32_mle(snd.una, seg.ack) and u32_mle(seg.ack, snd.nxt):
         # Woo!
         if self._establish(packet) is False:
           # Ack!  Abort!
@@ -1585,19 +1627,19 @@ class Socket (object):
       # This part of 793 seems like kind of a mess
       # It's also sort of the heart of normal RX operations.
 
-      if seg.ack |MGT| snd.nxt:
+      if u32_mgt(seg.ack, snd.nxt):
         # Acking beyond what we've sent!  Send an ACK and ignore
         self._set_ack_pending()
         self.log.info("Bad ACK ignored")
         return
-      elif seg.ack |MLT| snd.una:
+      elif u32_mlt(seg.ack, snd.una):
         # It's a duplicate ACK
         self.log.info("Got duplicate ACK ack:%s (seq:%s) or ack:%s (seq:%s)",
                       seg.ack, seg.seq,
-                      seg.ack|MINUS|self.snd.isn, seg.seq|MINUS|self.rcv.isn)
+                      u32_minus(seg.ack, self.snd.isn), u32_minus(seg.seq, self.rcv.isn))
         pass
 
-      if (snd.una |MLE| seg.ack) and (seg.ack |MLE| snd.nxt):
+      if u32_mle(snd.una, seg.ack) and u32_mle(seg.ack, snd.nxt):
         # Above is updated by RFC 1122 (g)
 
         # Fast retransmit/recovery stuff from RFC 5681 S3.2
@@ -1611,8 +1653,8 @@ class Socket (object):
               # Limited transmit RFC 3042 / RFC 5681 3.2 (1) p9
               self.limited_transmit_sent = 0
             elif self._dup_ack_count == 3:
-              if seg.ACK and (seg.ack|MINUS|1) |MGT| self._recover: # RFC 6582 3.2
-                self._recover = self.snd.nxt |MINUS| 1
+              if seg.ACK and u32_mgt(u32_minus(seg.ack, 1), self._recover): # RFC 6582 3.2
+                self._recover = u32_minus(self.snd.nxt, 1)
                 self._in_fast_recovery = True
                 # RFC 5681 3.2 (2) p9
                 self.ssthresh = (self.flight_size-self.limited_transmit_sent)/2
@@ -1621,21 +1663,21 @@ class Socket (object):
                 # This step of the RFC doesn't actually have a condition
                 # associated with it, but I think it just follows immediately
                 # after the previous one.
-                self.cwnd = self.ssthresh + 3 * self.smss
-                self.log.info("FAST RETX %s %s", self.snd.una|MINUS|self.snd.isn, seg.ack|MINUS|self.snd.isn)
+                self._set_cwnd(self.ssthresh + 3 * self.smss)
+                self.log.info("FAST RETX %s %s", u32_minus(self.snd.una, self.snd.isn), u32_minus(seg.ack, self.snd.isn))
                 if not self._maybe_retx(self.snd.una):
                   self.log.warn("No retransmission in fast retransmit")
           else:
             # RFC 5681 3.2 (4) p9
             # We're in fast recovery.  We inflate the window, which should
             # allow more segments to be sent.
-            self.cwnd += self.smss
+            self._set_cwnd(self.cwnd + self.smss)
         else:
           self._dup_ack_count = 0
 
         self._process_ack(seg.ack)
 
-        if (snd.una |MLT| seg.ack):
+        if u32_mlt(snd.una, seg.ack):
 
           # SS/CA signal for RFC 5681
           self._on_unacked_data_acked(seg)
@@ -1645,9 +1687,9 @@ class Socket (object):
           self._reset_retx_timer() # RFC 6298 5.3
 
         # Update window
-        if ( (snd.wl1 |MLT| seg.seq)
+        if ( u32_mlt(snd.wl1, seg.seq)
             or
-           ( (snd.wl1 |EQ| seg.seq) and snd.wl2 |MLE| seg.ack) ):
+           ( u32_eq(snd.wl1, seg.seq) and u32_mle(snd.wl2, seg.ack)) ):
           snd.wnd = self._read_win(seg)
           snd.wl1 = seg.seq
           snd.wl2 = seg.ack
@@ -1717,11 +1759,11 @@ class Socket (object):
       # the connection is closed).
 
       # The FIN is conceptually "after" the payload
-      got_fin_seq = seg.seq |PLUS| len(payload)
+      got_fin_seq = u32_plus(seg.seq, len(payload))
 
-      if self.rcv.nxt |EQ| got_fin_seq:
+      if u32_eq(self.rcv.nxt, got_fin_seq):
         # Advance over the FIN
-        self.rcv.nxt = self.rcv.nxt |PLUS| 1
+        self.rcv.nxt = u32_plus(self.rcv.nxt, 1)
       else:
         self.log.warn("FIN seq isn't rcv.nxt (%s != %s) with payload size %s",
                       seg.seq, self.rcv.nxt, len(payload))
@@ -1750,11 +1792,11 @@ class Socket (object):
     seg = packet.tcp
     rcv = self.rcv
 
-    if seg.seq |MLT| rcv.nxt:
+    if u32_mlt(seg.seq, rcv.nxt):
       # Overlaps with data we already have; cut off the beginning
-      offset = rcv.nxt |MINUS| seg.seq
+      offset = u32_minus(rcv.nxt, seg.seq)
       data = payload[offset:]
-    elif seg.seq |EQ| rcv.nxt:
+    elif u32_eq(seg.seq, rcv.nxt):
       data = payload
     else:
       # segment in future
@@ -1767,7 +1809,7 @@ class Socket (object):
 
     if not data: return
 
-    rcv.nxt = rcv.nxt |PLUS| len(data)
+    rcv.nxt = u32_plus(rcv.nxt, len(data))
 
     #TODO: Congestion control?
     rcv.wnd -= len(data)
@@ -1816,6 +1858,13 @@ class Socket (object):
       self._snd_wnd_shift = 0
       self._rcv_wnd_shift = 0
 
+    # The SYN exchange is done, so we know the MSS and can set the initial
+    # window.  If our SYN timed out, _on_rto_retx() will have already set
+    # cwnd to the loss window, which is what RFC 5681 S3.1 p7 wants.
+    self._set_iw()
+    if self.cwnd is None:
+      self._set_cwnd(self._iw)
+
     self.state = ESTABLISHED
     return True
 
@@ -1903,6 +1952,7 @@ class Socket (object):
 
   _fin_pending = False
   _fin_sent = False
+  _can_send_fin_now = False # FIN pending, not sent, and tx_data empty
   _fin_seqno = None # if _fin_sent, this is the FIN's seqno
   _fin_next_state = None
 
@@ -1919,7 +1969,7 @@ class Socket (object):
     #      slightly different queries.
     if self._fin_seqno is None: return False # We haven't sent, so no!
 
-    if ack |MGE| self._fin_seqno: return True
+    if u32_mge(ack, self._fin_seqno): return True
 
     return False
 
@@ -1945,6 +1995,7 @@ class Socket (object):
       return
     self._fin_pending = True
     self._fin_next_state = next_state
+    self._can_send_fin_now = not (self._fin_sent or self.tx_data)
     self._maybe_send_pending_fin()
 
 
@@ -1958,11 +2009,13 @@ class Socket (object):
 
     We could think about piggybacking this on a data segment, but we
     currently don't.
+
+    Whether we can send it is tracked in _can_send_fin_now, which is
+    updated whenever the FIN state changes or tx_data drains.
     """
-    if not self._fin_pending: return
-    if self._fin_sent: return
-    if self.tx_data: return # Still data to be sent
+    if not self._can_send_fin_now: return
 
+    self._can_send_fin_now = False
     self._fin_pending = False
     self._fin_sent = True
     if self._fin_next_state is not None:
@@ -1972,8 +2025,9 @@ class Socket (object):
     rp.tcp.FIN = True
     self._tx(rp)
 
-    self.snd.nxt = rp.tcp.seq |PLUS| 1 # FIN takes up seq space
-    self._fin_seqno = self.snd.nxt
+    fin_seqno = u32_plus(rp.tcp.seq, 1) # FIN takes up seq space
+    self.snd.nxt = fin_seqno
+    self._fin_seqno = fin_seqno
 
   # -------------------------------------------------------------------------
 
@@ -2028,12 +2082,14 @@ class Socket (object):
     """
     if reset_backoff: self._zwps_sent = 0
     backoff = self._zwps_sent + 1
-    interval = min(backoff * self.rto, self._zwp_max_interval)
+    rto = self.rto
+    max_interval = self._zwp_max_interval
+    interval = min(backoff * rto, max_interval)
     self._zwp_at = self.stack.now + interval
 
     # Just for logging purposes...
-    prev_interval = min((backoff-1) * self.rto, self._zwp_max_interval)
-    if interval == self._zwp_max_interval and prev_interval != interval:
+    prev_interval = min((backoff-1) * rto, max_interval)
+    if interval == max_interval and prev_interval != interval:
       self.log.debug("Zero window probe timeout at the maximum")
 
 
@@ -2046,20 +2102,22 @@ class Socket (object):
     # be off.
     """
     if self.state in (LISTEN,CLOSED): return
+    zwp_at = self._zwp_at
     if self.rcv.wnd != 0:
-      if self._zwp_at is not None:
+      if zwp_at is not None:
         # Stop timer
         self.log.debug("Receive window no longer zero")
         self._zwp_at = None
       return
-    elif self._zwp_at is None:
+    elif zwp_at is None:
       if not self.tx_data: return # No need to probe
       # Timer should be running!
       self._zwps_sent = 0 # make sure is reset
       # ZWP timer not running, but should be!
       self._reset_zwp_timer()
+      zwp_at = self._zwp_at
 
-    if self.stack.now < self._zwp_at: return # Not elapsed yet
+    if self.stack.now < zwp_at: return # Not elapsed yet
 
     if self._zwps_sent == 0:
       self.log.debug("Sending zero window probes")
@@ -2068,7 +2126,7 @@ class Socket (object):
     self._reset_zwp_timer(reset_backoff=False) # Keep it going
 
     p = self._new_packet()
-    p.tcp.seq = p.tcp.seq |MINUS| 1 # Keepalive-like; one less than window
+    p.tcp.seq = u32_minus(p.tcp.seq, 1) # Keepalive-like; one less than window
     self._tx(p)
 
   # -------------------------------------------------------------------------
@@ -2111,7 +2169,7 @@ class Socket (object):
       # RFC 5681 p7 (4)
       self.ssthresh = max(self.flight_size/2, 2*self.smss)
 
-    self.cwnd = self.LW # Back to slow start
+    self._set_cwnd(self.LW) # Back to slow start
 
 
   def _maybe_update_rto (self, seg):
@@ -2120,8 +2178,12 @@ class Socket (object):
 
     This only uses classic once-per-window RTT measurement.  Timestamp-based
     RTT measurment is done by _process_timestamp().
+
+    rx() only calls this for ACKs which acknowledge new data, since other
+    ACKs can't correspond to anything in the retx queue.
     """
     if not seg.ACK: return # Couldn't be responding to a sample!
+    if not self.retx_queue: return # Nothing we could have sampled
 
     # This is similar to the expensive timestamp RTT update heuristic.
     # We search through the retx queue and find the packet that is
@@ -2138,35 +2200,33 @@ class Socket (object):
 
     # Here, we use the (expensive but better?) heuristic of making sure
     # the ACK corresponds to something in the retx queue.
-    for p in self.retx_queue:
-      if seg.ack |MGT| p.tcp.seq:
-        if seg.ack |MLE| (p.tcp.seq |PLUS| tcplen(p.tcp)):
-          # This ACK falls within this packet.  Suitable for estimation.
-          #NOTE: ACK division (as in TCP Daytona) can actually cause us
-          #      to overly-weight the divided packet's RTT.  We might
-          #      want to only consider ACKs which end exactly on a
-          #      particular packet.  This goes for timestamp-based RTT
-          #      estimation as well.
-          if p.retx_ts is not None:
-            # It's been retransmitted, so we don't want to use it for RTT
-            # estimation after all.
-            break
-
+    i = self.retx_queue.find_acked(seg.ack)
+    if i is not None:
+      # This ACK falls within this packet.  Suitable for estimation.
+      #NOTE: ACK division (as in TCP Daytona) can actually cause us
+      #      to overly-weight the divided packet's RTT.  We might
+      #      want to only consider ACKs which end exactly on a
+      #      particular packet.  This goes for timestamp-based RTT
+      #      estimation as well.
+      p = self.retx_queue[i]
+      # If it's been retransmitted, we don't want to use it for RTT
+      # estimation after all.
+      if p.retx_ts is None:
+        if self.log.isEnabledFor(logging.DEBUG):
           self.log.debug("Maybe using packet to update RTO (rack:%s ack:%s "
-                         "una:%s nxt:%s)", seg.ack|MINUS|self.snd.isn, seg.ack,
-                                           self.snd.una,self.snd.nxt)
-          t = self.stack.now - p.tx_ts
-          if t > 0: #TODO: More sanity checks?
-            expected_samples = ceil(self.flight_size / (self.smss * 2))
-            # Hmm... Why not partial expected_samples?
-            if expected_samples > 0: # At least one expected sample!
-              self._update_rto(t, expected_samples)
+                         "una:%s nxt:%s)", u32_minus(seg.ack, self.snd.isn),
+                         seg.ack, self.snd.una,self.snd.nxt)
+        t = self.stack.now - p.tx_ts
+        if t > 0: #TODO: More sanity checks?
+          expected_samples = ceil(self.flight_size / (self.smss * 2))
+          # Hmm... Why not partial expected_samples?
+          if expected_samples > 0: # At least one expected sample!
+            self._update_rto(t, expected_samples)
 
-          return
-      else:
-        break
+        return
 
-    self.log.debug("Not using packet to update RTO (rack:%s)", seg.ack|MINUS|self.snd.isn) #XXX
+    if self.log.isEnabledFor(logging.DEBUG):
+      self.log.debug("Not using packet to update RTO (rack:%s)", u32_minus(seg.ack, self.snd.isn)) #XXX
     #NOTE: We used to reset the rtt sample variable here.
 
 
@@ -2196,13 +2256,15 @@ class Socket (object):
 
     #self.rto = ceil(self.rto * 2) / 2.0 # Quantize to half-sec (nice for debug)
 
-    msg = ( "RTO now %0.3f (was:%0.3f - R:%0.3f SRTT:%0.3f RTTVAR:%0.3f)"
-            % (self.rto, old_rto, R, self.srtt, self.rttvar) )
     #if self.rto != old_rto:
     if abs(self.rto - old_rto) > 0.5: # Big change
-      self.log.info(msg)
+      level = logging.INFO
     else:
-      self.log.debug(msg)
+      level = logging.DEBUG
+    if self.log.isEnabledFor(level):
+      self.log.log(level,
+                   "RTO now %0.3f (was:%0.3f - R:%0.3f SRTT:%0.3f RTTVAR:%0.3f)",
+                   self.rto, old_rto, R, self.srtt, self.rttvar)
 
 
   def _back_off_rto (self):
@@ -2244,44 +2306,51 @@ class Socket (object):
   # Timestamp we last sent data, for RFC 5681 p4.1 p11
   last_send_ts = None # None means ignore
 
-  # We do cwnd as a property so that it calculates IW as late as possible
-  # (e.g., possibly after the MSS option) without having to maybe check/set
-  # it in multiple places.
-  _cwnd = None
-  @property
-  def cwnd (self):
-    if self._cwnd is None:
-      self._cwnd = self.IW
-    return self._cwnd
-  @cwnd.setter
-  def cwnd (self, value):
-    if value != self.cwnd: self.log.debug("CWND CHANGE %s -> %s (flgt:%s)", self._cwnd, value, self.flight_size) #XXX
+  # cwnd is read a lot, so it's a plain attribute.  It's None until we
+  # establish, at which point we know the MSS and can compute IW.  It should
+  # only be changed via _set_cwnd().
+  cwnd = None
+
+  def _set_cwnd (self, value):
+    if value != self.cwnd and self.log.isEnabledFor(logging.DEBUG):
+      self.log.debug("CWND CHANGE %s -> %s (flgt:%s)", self.cwnd, value, self.flight_size) #XXX
     if value < 0:
       self.log.warn("CWND being set to negative value")
       return
-    self._cwnd = value
+    self.cwnd = value
+    self._select_cc_on_ack()
 
   @property
   def flight_size (self):
-    return self.snd.nxt |MINUS| self.snd.una
+    return u32_minus(self.snd.nxt, self.snd.una)
 
   @property
   def in_slow_start (self):
     return self.cwnd < self.ssthresh
 
+  _iw = None # Set by _set_iw()
+
   @property
   def IW (self):
     """
     Initial window as per RFC 5681
     """
+    return self._iw
+
+  def _set_iw (self):
+    """
+    Computes the initial window
+
+    This is called once we've established, since SMSS is fixed by then.
+    """
     #RFC 5681 S3.1 p5
     #NOTE: This may need updating for PMTUD (RFC 1191).  See RFC 5681 p5.
     smss = self.smss
     # The RFC also says these MOST NOT be more than 2, 3, and 4 segments.
     # What else do we need to do to ensure that?
-    if smss > 2190: return 2 * smss
-    elif smss > 1095: return 3 * smss
-    return 4 * smss
+    if smss > 2190: self._iw = 2 * smss
+    elif smss > 1095: self._iw = 3 * smss
+    else: self._iw = 4 * smss
 
   @property
   def LW (self):
@@ -2295,66 +2364,104 @@ class Socket (object):
     """
     Restart Window per RFC 5681 S4.1 p11
     """
-    return min(self.IW, self.cwnd)
+    return min(self._iw, self.cwnd)
 
 
   def _on_unacked_data_acked (self, seg):
     """
     Called when "new" data is ACKed
 
-    Previously unacknowledged data has now been ACKed
-
-    acked_bytes is the count of ACKed bytes
-    was_in_frr is True if we had been in FRR
+    Previously unacknowledged data has now been ACKed, so we pass the
+    count of ACKed bytes along to the current congestion control handler
+    (see _select_cc_on_ack()).
     """
-    acked_bytes = seg.ack |MINUS| self.snd.una
+    acked_bytes = u32_minus(seg.ack, self.snd.una)
 
     assert acked_bytes > 0
 
+    self._cc_on_ack(seg, acked_bytes)
+
+
+  def _select_cc_on_ack (self):
+    """
+    Picks the handler _on_unacked_data_acked() will call
+
+    Which one is right depends on cwnd, ssthresh, and whether we're in FRR.
+    Rather than figuring that out on every ACK, we do it here whenever one
+    of those changes.  (ssthresh is only ever changed right before cwnd,
+    so _set_cwnd() takes care of it.)
+    """
     if self._in_fast_recovery:
-      # This is based on RFC 6582 3.2 (3) p5 (NewReno)
-      if seg.ack |MGT| self._recover:
-        # Full acknowledgement
-        self.log.debug("FRR Full ACK")
-        # Deflate the window
-        self.cwnd = min(self.ssthresh, max(self.flight_size, self.smss) + self.smss)
-        self._exit_frr()
-      else:
-        # Partial acknowledgement
-        self.log.debug("FRR Partial ACK; retx rseq:%s seq:%s", self.snd.una|MINUS|self.snd.isn, self.snd.una) #XXX
-        if not self._maybe_retx(self.snd.una):
-          self.log.warn("No retransmission in NewReno fast retransmit")
-        self.cwnd -= acked_bytes
-        if acked_bytes >= self.smss:
-          self.cwnd += self.smss
-        self._partial_ack_count += 1
-        if self._partial_ack_count == 1:
-          self._reset_retx_timer()
-      return
+      self._cc_on_ack = self._cc_frr
+    elif self.cwnd < self.ssthresh:
+      self._cc_on_ack = self._cc_ss
+    else:
+      self._cc_on_ack = self._cc_ca
+
+
+  def _cc_frr (self, seg, acked_bytes):
+    """
+    Handles newly ACKed data while in fast recovery
+    """
+    # This is based on RFC 6582 3.2 (3) p5 (NewReno)
+    if u32_mgt(seg.ack, self._recover):
+      # Full acknowledgement
+      self.log.debug("FRR Full ACK")
+      # Deflate the window
+      smss = self.smss
+      self._set_cwnd(min(self.ssthresh, max(self.flight_size, smss) + smss))
+      self._exit_frr()
+    else:
+      # Partial acknowledgement
+      if self.log.isEnabledFor(logging.DEBUG):
+        self.log.debug("FRR Partial ACK; retx rseq:%s seq:%s", u32_minus(self.snd.una, self.snd.isn), self.snd.una) #XXX
+      if not self._maybe_retx(self.snd.una):
+        self.log.warn("No retransmission in NewReno fast retransmit")
+      smss = self.smss
+      cwnd = self.cwnd - acked_bytes
+      if acked_bytes >= smss:
+        cwnd += smss
+      self._set_cwnd(cwnd)
+      self._partial_ack_count += 1
+      if self._partial_ack_count == 1:
+        self._reset_retx_timer()
 
+
+  def _cc_ss (self, seg, acked_bytes):
+    """
+    Handles newly ACKed data while in slow start
+    """
     # RFC 5681 S3.1 p6
+    smss = self.smss
     old_cwnd = self.cwnd
-    if self.in_slow_start:
-      self.cwnd += min(acked_bytes, self.smss)
-      #XXX Uncomment this log!
-      self.log.debug("SS CWND %s -> %s (acked_bytes:%s smss:%s)",
-                     old_cwnd, self.cwnd, acked_bytes, self.smss)
-      if not self.in_slow_start:
-        self.log.error("Leaving slow start and entering congestion avoidance")
-        self.ca_acked_bytes = 0
-    else: # congestion avoidance
-      # This is (hopefully) the recommended method from RFC 5681 p6
-      # It uses a new state variable (ca_acked_bytes), but avoids
-      # Daytona ACK division issues as in TCP ABC (RFC 3465).
-      # Note that if there are "extra" acked bytes (beyond cwnd), we
-      # just throw them away.  This is sort of inexact, but it's meant
-      # to make sure that we never increment more than SMSS per RTT
-      # which is what the RFC wants.
-
-      self.ca_acked_bytes += acked_bytes
-      if self.ca_acked_bytes >= self.cwnd:
-        self.cwnd += self.smss
-        self.ca_acked_bytes = 0
+    cwnd = old_cwnd + min(acked_bytes, smss)
+    self._set_cwnd(cwnd)
+    #XXX Uncomment this log!
+    self.log.debug("SS CWND %s -> %s (acked_bytes:%s smss:%s)",
+                   old_cwnd, cwnd, acked_bytes, smss)
+    if cwnd >= self.ssthresh:
+      self.log.error("Leaving slow start and entering congestion avoidance")
+      self.ca_acked_bytes = 0
+
+
+  def _cc_ca (self, seg, acked_bytes):
+    """
+    Handles newly ACKed data while in congestion avoidance
+    """
+    # This is (hopefully) the recommended method from RFC 5681 p6
+    # It uses a new state variable (ca_acked_bytes), but avoids
+    # Daytona ACK division issues as in TCP ABC (RFC 3465).
+    # Note that if there are "extra" acked bytes (beyond cwnd), we
+    # just throw them away.  This is sort of inexact, but it's meant
+    # to make sure that we never increment more than SMSS per RTT
+    # which is what the RFC wants.
+
+    cab = self.ca_acked_bytes + acked_bytes
+    cwnd = self.cwnd
+    if cab >= cwnd:
+      self._set_cwnd(cwnd + self.smss)
+      cab = 0
+    self.ca_acked_bytes = cab
 
 
   def _exit_frr (self):
@@ -2365,6 +2472,7 @@ class Socket (object):
     self.limited_transmit_sent = 0
     self._in_fast_recovery = False
     self._partial_ack_count = 0
+    self._select_cc_on_ack()
 
 
   def _INIT_newreno (self):
@@ -2378,12 +2486,17 @@ class Socket (object):
     # Number of partial ACKs in FRR
     self._partial_ack_count = 0
 
+    # Handler for newly ACKed data (see _select_cc_on_ack()).  We can't
+    # actually call _select_cc_on_ack() yet since cwnd isn't set until we
+    # establish, but we always start in slow start anyway.
+    self._cc_on_ack = self._cc_ss
+
 
   def snd_una_advance (self, ackno):
-    greater = self.snd.una |MGE| self._recover
+    greater = u32_mge(self.snd.una, self._recover)
     self.snd.una_advance(ackno)
     if not self._in_fast_recovery:
-      if (self.snd.una |MGE| self._recover) != greater:
+      if u32_mge(self.snd.una, self._recover) != greater:
         # We've wrapped around so just set it to the start.
         # (This is an attempt to address the issue mentioned in paragraph 3 of
         # RFC 6582 S6.)
@@ -2422,8 +2535,8 @@ class Socket (object):
     self._ts_hash &= 0xffFF # Chop high bits off (Easier to read)
 
   def _gen_timestamp (self):
-    ts = int(self.stack.now * 1000 / self._ts_granularity) # 10ms granularity
-    ts = ts |PLUS| self._ts_hash
+    ts = self.stack.now_ms // self._ts_granularity
+    ts = u32_plus(ts, self._ts_hash)
     return ts
 
   def _process_timestamp (self, seg):
@@ -2438,12 +2551,17 @@ class Socket (object):
           self.log.error("Was expecting TCP timestamp, but didn't get one")
       return
     tsval,tsech = ts.val
-    if (self._ts_recent is None) or (tsval |MGE| self._ts_recent):
-      if (self._ts_last_ack is None) or (seg.seq |MLE| self._ts_last_ack):
+    if (self._ts_recent is None) or u32_mge(tsval, self._ts_recent):
+      if (self._ts_last_ack is None) or u32_mle(seg.seq, self._ts_last_ack):
         if tsval != 0:
           # We ignore TS values of 0 since middleboxes may be causing them.
           # Is this a good idea?
           self._ts_recent = tsval
+    if u32_mle(seg.ack, self.snd.una):
+      # RFC 7323 S4.2 says TSecr should only be used for RTT measurement if
+      # the segment advances SND.UNA, so skip the (comparatively expensive)
+      # RTT stuff below for duplicate ACKs, window updates, etc.
+      return
     if (tsech != 0):
       # Again, ignore 0
       ts_update = False
@@ -2476,30 +2594,26 @@ class Socket (object):
         if self.expensive_ts_heuristic:
           # Here, we use the (expensive but better?) heuristic of making sure
           # the ACK corresponds to something in the retx queue.
-          for p in self.retx_queue:
-            if seg.ack |MGT| p.tcp.seq:
-              if seg.ack |MLE| (p.tcp.seq |PLUS| tcplen(p.tcp)):
-                # This ACK falls within this packet.  Suitable for estimation
-                ts_update = True
-                break
-            else:
-              break
+          if self.retx_queue.find_acked(seg.ack) is not None:
+            # This ACK falls within a packet.  Suitable for estimation
+            ts_update = True
         else:
           # Here's the simple heuristic.  It only is really meant to accomplish
           # two things: 1) Make sure it's not some completely rogue packet
           # (possibly spoofed), 2) Make sure it might be timely.  We do this
           # by making sure that we are expecting ACKs and that this ACK is not
           # beyond what we've sent.
-          if self.snd.una |NE| self.snd.nxt:
-            if seg.ack |MLE| self.snd.nxt:
+          if u32_ne(self.snd.una, self.snd.nxt):
+            if u32_mle(seg.ack, self.snd.nxt):
               ts_update = True
 
       if ts_update:
         # Sloppy log message...
-        self.log.debug("Maybe using TS to update RTO (rack:%s ack:%s una:%s"
-                       " nxt:%s)", seg.ack|MINUS|self.snd.isn, seg.ack,
-                                   self.snd.una,self.snd.nxt)
-        tsdif = self._gen_timestamp() |MINUS| tsech
+        if self.log.isEnabledFor(logging.DEBUG):
+          self.log.debug("Maybe using TS to update RTO (rack:%s ack:%s una:%s"
+                         " nxt:%s)", u32_minus(seg.ack, self.snd.isn), seg.ack,
+                                     self.snd.una,self.snd.nxt)
+        tsdif = u32_minus(self._gen_timestamp(), tsech)
         t = float(tsdif) * self._ts_granularity / 1000
         if t > 0: #TODO: More sanity checks?
           expected_samples = ceil(self.flight_size / (self.smss * 2))
@@ -45,17 +45,20 @@ def seconds_to_str (s, fractional=None):
 
   By default, fractional is automatic, but can be overridden with True/False.
   """
-  s,ps = divmod(s, 1)
-  m, s = divmod(s, 60)
+  whole = math.floor(s)
+  ps = s - whole
+  m, s = divmod(whole, 60)
   h, m = divmod(m, 60)
   r = "%02i:%02i:%02i" % (h, m, s)
   if ((fractional is True)
       or (fractional is None and ps != 0)):
-    r += (".%0.3f" % (ps,))[2:]
+    r += ("%0.3f" % (ps,))[1:]
   return r
 
 
 
+_bps_units = (("Gbps",Gbps), ("Mbps",Mbps), ("kbps",kbps), ("bps",bps))
+
 def bps_to_str (bits, duration=None):
   """
   Format a nice bitrate
@@ -75,11 +78,7 @@ def bps_to_str (bits, duration=None):
       bps = bits/float(duration)
   else:
     bps = bits
-  for n in "Gbps Mbps kbps bps".split():
-    f = globals()[n]
+  for n,f in _bps_units:
     if f > bps: continue
     r = "%0.3f" % (float(bps)/f,)
-    # There is surely a better way, but I never remember it...
-    while r.endswith("0"): r = r[:-1]
-    if r.endswith("."): r = r[:-1]
-    return r + n
+    return r.rstrip("0").rstrip(".") + n
@@ -36,6 +36,7 @@ The src and dst are Nodes (just like with Queues).
 
 
 from tcpip.units import *
+from . netdev import l4_protocols
 
 
 
@@ -66,6 +67,25 @@ class SimpleWire (Wire):
     if rate is not None: self.rate = rate
     if latency is not None: self.latency = latency
     self.drop_conditions = []
+    self._l4_drop_conditions = {} # IP protocol -> (L4 class, [conditions])
+
+  def add_drop_condition (self, condition, protocol=None):
+    """
+    Adds a condition for dropping packets
+
+    condition(wire, packet) should return True to drop the (IP) packet.
+    If protocol is "tcp", "udp", or "icmp", the condition is only checked
+    for packets of that protocol, and it's called as
+    condition(wire, packet, l4), where l4 is the already-parsed transport
+    layer.  Such conditions are checked after those in drop_conditions.
+    """
+    if protocol is None:
+      self.drop_conditions.append(condition)
+      return
+    protocol_number,protocol_class = l4_protocols[protocol]
+    entry = self._l4_drop_conditions.setdefault(protocol_number,
+                                                (protocol_class, []))
+    entry[1].append(condition)
 
   def _check_drop (self, packet):
     """
@@ -75,6 +95,13 @@ class SimpleWire (Wire):
     """
     for d in self.drop_conditions:
       if d(self, packet): return True
+    if self._l4_drop_conditions:
+      entry = self._l4_drop_conditions.get(packet.protocol)
+      if entry is not None:
+        l4 = packet.next
+        if type(l4) is entry[0]:
+          for d in entry[1]:
+            if d(self, packet, l4): return True
     return False
 
   def transmit (self, packet):